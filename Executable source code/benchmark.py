@@ -0,0 +1,523 @@
+"""
+runs the fitting pipeline on the sample data and generated larger inputs, and compares fit results,
+stage timings and peak memory against stored golden values. Exits with status 1 if accuracy or
+speed has regressed, use --update to store the current results as the new golden values.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import matplotlib
+
+matplotlib.use("Agg")
+import fitter
+from library import CV, diffusional_fit, find_couples, MAX_DELTA_EP, peak_rss, detect_format, read_data, data_formats, DETECT_FORMAT
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Sample data")
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_golden.json")
+STAGES = ["read", "baseline", "diffusional", "save"]
+RESULT_KEYS = ["Ip1", "Ip2", "peak_ratio", "popt", "linear_r_squared", "r_squared"]
+# results of multi-couple cases are lists with a value per couple, tail_r_squared is NaN for the
+# last couple which has no return tail, unpaired_peaks are the potentials of unpaired peaks
+MULTI_RESULT_KEYS = ["Ip1", "Ip2", "peak_ratio", "E_half", "r_squared", "tail_r_squared", "unpaired_peaks"]
+
+# generated inputs, sample file upsampled by the given factor with added noise
+GENERATED_INPUTS = {
+    "generated oxidation first x5": ("reversible oxidation first.csv", 5),
+    "generated reduction first x5": ("reversible reduction first.csv", 5),
+}
+
+# generated inputs of over 100k points, large enough for plot downsampling, the decimated peak
+# search and chunked reading in low memory mode. These are also run in low memory mode, and as
+# the moving linear fit takes seconds at this size they are run with the Cottrellian function
+# only and the linear fit is timed once. Its result is reused in the other timed runs, and its
+# time isn't compared to the golden value as a single run is too noisy to gate on
+LARGE_INPUTS = {
+    "generated oxidation first x450": ("reversible oxidation first.csv", 450),
+}
+LARGE_DIF_FUNCS = ["Cottrellian"]
+LARGE_SINGLE_RUN_STAGES = ["baseline"]
+
+# simulated inputs of several redox couples, run in multi-couple mode, as (couples, switching
+# potential, chain_couples), see simulate_couples. The middle couple of the second is consumed
+# by a fast chemical reaction so has no return peak, and its couples are fitted concurrently
+MULTI_COUPLE_INPUTS = {
+    "generated three couples": ([(0.0, 1.0, 0), (0.3, 0.8, 0), (0.6, 1.2, 0)], 0.9, True),
+    "generated irreversible middle couple": (
+        [(0.0, 1.0, 0), (0.45, 1.0, 200), (0.85, 1.0, 0)],
+        1.15,
+        False,
+    ),
+}
+MULTI_DIF_FUNCS = ["Cottrellian"]
+
+# sample file written in each data format to measure reader throughput
+FORMAT_INPUT = ("reversible oxidation first.csv", 100)
+
+# peak ratio is rounded to 4 decimal places when calculated
+ABSOLUTE_TOLERANCE_OVERRIDES = {"peak_ratio": 1e-4}
+
+
+# sample data upsampled by the given factor with seeded gaussian noise, returns scan rate, E and I
+def upsample(sample_name, factor):
+    with open(os.path.join(SAMPLE_DIR, sample_name), "r", encoding="utf-8-sig") as file:
+        scan_rate = float(file.readline().split(",")[1])
+    df = pd.read_csv(os.path.join(SAMPLE_DIR, sample_name), skiprows=1)
+    df = df.dropna(axis=1, how="all")
+    E, I = df.iloc[:, 0].to_numpy(), df.iloc[:, 1].to_numpy()
+
+    x = np.linspace(0, len(E) - 1, (len(E) - 1) * factor + 1)
+    E = np.round(np.interp(x, np.arange(len(E)), E), 9)
+    I = np.interp(x, np.arange(len(I)), I)
+    I += np.random.default_rng(0).normal(0, 0.002 * abs(I).max(), len(I))
+    return scan_rate, E, I
+
+
+def write_template(filename, scan_rate, E, I):
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(f"Scan rate (V/s),{scan_rate:g}\n")
+        pd.DataFrame({"E (V)": E, "I (A)": I}).to_csv(file, index=False)
+
+
+def write_CHI(filename, scan_rate, E, I):
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(
+            "Cyclic Voltammetry\nFile: benchmark\nInstrument Model:  CHI660E\n\n"
+            f"Init E (V) = {E[0]:g}\nHigh E (V) = {E.max():g}\nLow E (V) = {E.min():g}\n"
+            f"Scan Rate (V/s) = {scan_rate:g}\nSegment = 2\n"
+            f"Sample Interval (V) = {abs(E[1] - E[0]):.3g}\n\nPotential/V, Current/A\n\n"
+        )
+        np.savetxt(file, np.column_stack([E, I]), fmt=["%.6f", "%.4e"], delimiter=", ")
+
+
+def write_Nova(filename, scan_rate, E, I):
+    time = np.arange(len(E)) * abs(E[1] - E[0]) / scan_rate
+    pd.DataFrame(
+        {
+            "Time (s)": time,
+            "Potential applied (V)": E,
+            "WE(1).Current (A)": I,
+            "WE(1).Potential (V)": E,
+            "Scan": 1,
+        }
+    ).to_csv(filename, index=False)
+
+
+# current in uA, written with a byte order mark as by PSTrace
+def write_PSTrace(filename, scan_rate, E, I):
+    with open(filename, "w", encoding="utf-16") as file:
+        file.write("Date and time measurement:,2024-01-31 12:00:00\n\n")
+        file.write("Cyclic Voltammetry: CV i vs E\nScan 1\nE,I\nV,\u00b5A\n")
+        pd.DataFrame({"E": E, "I": I * 1e6}).to_csv(file, index=False, header=False)
+
+
+# current in mA
+def write_BioLogic(filename, scan_rate, E, I):
+    time = np.arange(len(E)) * abs(E[1] - E[0]) / scan_rate
+    with open(filename, "w", encoding="latin-1") as file:
+        file.write(
+            "EC-Lab ASCII FILE\nNb header lines : 7\n\nCyclic Voltammetry\n"
+            f"dE/dt               {scan_rate * 1000:.3f}\ndE/dt unit          mV/s\n"
+        )
+        pd.DataFrame(
+            {"mode": 2, "time/s": time, "Ewe/V": E, "<I>/mA": I * 1000, "cycle number": 1.0}
+        ).to_csv(file, index=False, sep="\t")
+
+
+def write_Gamry(filename, scan_rate, E, I):
+    time = np.arange(len(E)) * abs(E[1] - E[0]) / scan_rate
+    with open(filename, "w", encoding="latin-1") as file:
+        file.write(
+            "EXPLAIN\nTAG\tCV\nTITLE\tLABEL\tCyclic Voltammetry\tTest &Identifier\n"
+            f"SCANRATE\tQUANT\t{scan_rate * 1000:.5E}\tScan &Rate (mV/s)\n"
+            "CURVE1\tTABLE\n\tPt\tT\tVf\tIm\n\t#\ts\tV vs. Ref.\tA\n"
+        )
+        table = pd.DataFrame({"Pt": np.arange(len(E)), "T": time, "Vf": E, "Im": I})
+        table.insert(0, "", "")
+        table.to_csv(file, index=False, header=False, sep="\t")
+        file.write("EXPERIMENTABORTED\tLABEL\tFalse\n")
+
+
+FORMAT_WRITERS = {
+    "Template CSV file": write_template,
+    "CH Instruments text file": write_CHI,
+    "Nova ASCII export": write_Nova,
+    "PSTrace CSV export": write_PSTrace,
+    "BioLogic EC-Lab text file": write_BioLogic,
+    "Gamry DTA file": write_Gamry,
+}
+
+
+def generate_input(sample_name, factor, filename):
+    write_template(filename, *upsample(sample_name, factor))
+
+
+# CV of redox couples oxidised on the forward sweep, simulated by explicit finite differences for
+# planar diffusion, with capacitive current and seeded gaussian noise. Couples are given as
+# (E0 (V), concentration (mM), k (1/s)), where k is the rate of a chemical reaction consuming the
+# oxidised form, so a fast reaction leaves the couple without a return peak. Returns scan rate,
+# E and I
+def simulate_couples(couples, E_start=-0.3, E_switch=1.15, scan_rate=1.0, dE=0.001):
+    f = 96485 / 8.314 / 298
+    E = np.concatenate([np.arange(E_start, E_switch, dE), np.arange(E_switch, E_start - dE / 2, -dE)])
+    D, area, substeps = 1e-5, 0.07, 5  # cm^2/s, cm^2
+    dt = dE / scan_rate / substeps
+    dx = np.sqrt(D * dt / 0.4)
+    n = int(6 * np.sqrt(D * len(E) * dE / scan_rate) / dx) + 10
+    I = np.zeros(len(E))
+    for E0, concentration, k in couples:
+        red, ox = np.ones(n), np.zeros(n)
+        for i, potential in enumerate(E):
+            ratio = np.exp(f * (potential - E0))
+            for _ in range(substeps):
+                # nernstian surface concentrations conserving the flux of both forms
+                surface = red[1] + ox[1]
+                red[0], ox[0] = surface / (1 + ratio), surface * ratio / (1 + ratio)
+                red[1:-1] += 0.4 * (red[2:] - 2 * red[1:-1] + red[:-2])
+                ox[1:-1] += 0.4 * (ox[2:] - 2 * ox[1:-1] + ox[:-2]) - k * dt * ox[1:-1]
+            I[i] += 96485 * area * D * concentration * 1e-6 * (red[1] - red[0]) / dx
+    I += 2e-7 * np.sign(np.gradient(E))
+    I += np.random.default_rng(0).normal(0, 0.002 * abs(I).max(), len(I))
+    return scan_rate, np.round(E, 9), I
+
+
+# cases as (case name, filename, diffusional functions, chain_couples), simulated data is written
+# to input_dir
+def multi_couple_cases(input_dir):
+    cases = []
+    for case_name, (couples, E_switch, chain_couples) in MULTI_COUPLE_INPUTS.items():
+        filename = os.path.join(input_dir, f"{case_name}.csv")
+        write_template(filename, *simulate_couples(couples, E_switch=E_switch, dE=0.002))
+        cases.append((case_name, filename, MULTI_DIF_FUNCS, chain_couples))
+    return cases
+
+
+# cases as (case name, filename, diffusional functions, low memory mode, stages timed once)
+def benchmark_cases(input_dir, args):
+    dif_funcs = ["Cottrellian", "Shoup-Szabo"]
+    cases = []
+    for filename in sorted(os.listdir(SAMPLE_DIR)):
+        if filename.endswith(".csv") and filename != "template.csv":
+            cases.append(
+                (filename, os.path.join(SAMPLE_DIR, filename), dif_funcs, args.low_memory, [])
+            )
+    for case_name, (sample_name, factor) in GENERATED_INPUTS.items():
+        filename = os.path.join(input_dir, f"{case_name}.csv")
+        generate_input(sample_name, factor, filename)
+        cases.append((case_name, filename, dif_funcs, args.low_memory, []))
+    for case_name, (sample_name, factor) in LARGE_INPUTS.items():
+        filename = os.path.join(input_dir, f"{case_name}.csv")
+        generate_input(sample_name, factor, filename)
+        cases.append(
+            (case_name, filename, LARGE_DIF_FUNCS, args.low_memory, LARGE_SINGLE_RUN_STAGES)
+        )
+        if not args.low_memory:
+            cases.append(
+                (f"{case_name} low memory", filename, LARGE_DIF_FUNCS, True, LARGE_SINGLE_RUN_STAGES)
+            )
+    return cases
+
+
+# runs the same stages as fitter.fitter, each stage is run through measure(stage, func)
+def run_pipeline(userinput_dict, measure):
+    cv = measure("read", lambda: CV(userinput_dict))
+    baseline, x_reg, y_reg = measure("baseline", lambda: fitter.baseline_fit(cv, userinput_dict))
+    fitting_func = fitter.fitting_function(userinput_dict, cv, baseline)
+    popt, x_fit, r_squared = measure(
+        "diffusional",
+        lambda: diffusional_fit(
+            cv, userinput_dict, fitter.fitting_bounds(userinput_dict, cv), fitting_func
+        ),
+    )
+    name, peak_dict = measure(
+        "save",
+        lambda: fitter.save_fit(
+            cv, userinput_dict, baseline, x_reg, popt, x_fit, r_squared, fitting_func
+        ),
+    )
+    results = fitter.fit_results(name, peak_dict, baseline, popt, r_squared)
+    results["data_format"] = cv.data_format
+    return results
+
+
+# runs the same stages as fitter.multi_fitter, finding the couples is part of the read stage and
+# fitting the couples and their return tails is the diffusional stage
+def run_multi_pipeline(userinput_dict, measure):
+    def read():
+        cv = CV(userinput_dict)
+        return cv, find_couples(
+            cv,
+            userinput_dict.get("min_peak_prominence", 0.1),
+            userinput_dict.get("max_delta_Ep", MAX_DELTA_EP),
+        )
+
+    cv, (couples, unpaired) = measure("read", read)
+    userinput_dict = dict(userinput_dict, fit_range_check=True)
+    baseline, x_reg, y_reg = measure(
+        "baseline", lambda: fitter.baseline_fit(couples[0], userinput_dict)
+    )
+    couple_fits = measure(
+        "diffusional", lambda: fitter.fit_couples(couples, userinput_dict, baseline)
+    )
+    measure(
+        "save",
+        lambda: fitter.save_multi_fit(
+            cv, userinput_dict, baseline, x_reg, couple_fits, None, len(couples), unpaired
+        ),
+    )
+    results = {key: [] for key in MULTI_RESULT_KEYS}
+    for fit in couple_fits:
+        for key in ["Ip1", "Ip2", "peak_ratio"]:
+            results[key].append(float(fit["peak_dict"][key]))
+        results["E_half"].append(float(fit["couple"].E_half))
+        results["r_squared"].append(float(fit["r_squared"]))
+        results["tail_r_squared"].append(
+            np.nan if fit["tail"] is None else float(fit["tail"]["r_squared"])
+        )
+    results["unpaired_peaks"] = [float(E) for sweep, E in unpaired]
+    results["data_format"] = cv.data_format
+    return results
+
+
+# best wall time of each stage over several runs, then peak memory of each stage in a separate
+# run as tracemalloc slows down the code it traces. Stages timed once are run in the first run
+# only, later runs reuse their result
+def profile_case(userinput_dict, repeat, pipeline=run_pipeline, single_run_stages=()):
+    stage_times = {stage: np.inf for stage in STAGES}
+    single_run_values = {}
+    for _ in range(repeat):
+
+        def timed(stage, func):
+            if stage in single_run_values:
+                return single_run_values[stage]
+            start = time.perf_counter()
+            value = func()
+            stage_times[stage] = min(stage_times[stage], time.perf_counter() - start)
+            if stage in single_run_stages:
+                single_run_values[stage] = value
+            return value
+
+        results = pipeline(userinput_dict, timed)
+
+    stage_memory = {}
+
+    def traced(stage, func):
+        tracemalloc.start()
+        try:
+            return func()
+        finally:
+            stage_memory[stage] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    pipeline(userinput_dict, traced)
+    return {
+        "results": results,
+        "time": stage_times,
+        "memory": stage_memory,
+        "single_run_stages": list(single_run_stages),
+    }
+
+
+def compare(case_name, profile, golden, args, result_keys=RESULT_KEYS):
+    failures = []
+    for key in result_keys:
+        atol = ABSOLUTE_TOLERANCE_OVERRIDES.get(key, args.atol)
+        value = np.atleast_1d(profile["results"][key])
+        golden_value = np.atleast_1d(golden["results"][key])
+        if value.shape != golden_value.shape or not np.allclose(
+            value, golden_value, rtol=args.rtol, atol=atol, equal_nan=True
+        ):
+            failures.append(
+                f"{case_name}: {key} {golden['results'][key]} -> {profile['results'][key]}"
+            )
+
+    for stage in STAGES:
+        time_limit = golden["time"][stage] * args.time_factor + args.time_slack
+        if stage not in profile["single_run_stages"] and profile["time"][stage] > time_limit:
+            failures.append(
+                f"{case_name}: {stage} time {golden['time'][stage]:.4f} -> {profile['time'][stage]:.4f} s"
+            )
+        memory_limit = golden["memory"][stage] * args.memory_factor + args.memory_slack
+        if profile["memory"][stage] > memory_limit:
+            failures.append(
+                f"{case_name}: {stage} peak memory {golden['memory'][stage]} -> {profile['memory'][stage]} bytes"
+            )
+    return failures
+
+
+def print_profile(case_name, profile):
+    times = "  ".join(f"{stage} {profile['time'][stage] * 1000:7.1f}" for stage in STAGES)
+    memory = "  ".join(
+        f"{stage} {profile['memory'][stage] / 2**20:6.2f}" for stage in STAGES
+    )
+    print(f"{case_name}")
+    reader = data_formats[profile["results"]["data_format"]]["reader"].__name__
+    print(f"    format:      {profile['results']['data_format']} ({reader})")
+    print(f"    time (ms):   {times}")
+    print(f"    memory (MB): {memory}")
+    results = profile["results"]
+    if "E_half" not in results:
+        print(
+            f"    Ip1: {results['Ip1']:.6g}, Ip2: {results['Ip2']:.6g}, "
+            f"peak ratio: {results['peak_ratio']}, R-squared: {results['r_squared']:.6f}"
+        )
+        return
+    for i, E_half in enumerate(results["E_half"]):
+        print(
+            f"    couple {i + 1}, E1/2: {E_half:.4f} V, Ip1: {results['Ip1'][i]:.6g}, "
+            f"Ip2: {results['Ip2'][i]:.6g}, peak ratio: {results['peak_ratio'][i]}, "
+            f"R-squared: {results['r_squared'][i]:.6f}, tail R-squared: {results['tail_r_squared'][i]:.6f}"
+        )
+    for E in results["unpaired_peaks"]:
+        print(f"    unpaired peak at {E:.4f} V")
+
+
+# writes the same data in every data format and times format detection and reading, best of
+# several runs. Data read from each file is checked against the data written, returns the
+# timings of each format and any failures
+def profile_formats(input_dir, args):
+    scan_rate, E, I = upsample(*FORMAT_INPUT)
+    print(f"Data formats, {len(E)} rows")
+    timings = {}
+    failures = []
+    for name, writer in FORMAT_WRITERS.items():
+        filename = os.path.join(input_dir, f"format {writer.__name__}")
+        writer(filename, scan_rate, E, I)
+        userinput_dict = {"filename": filename, "scan_rate": scan_rate, "low_memory": args.low_memory}
+        detect_time = read_time = np.inf
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            userinput_dict["data_format"] = detect_format(filename)
+            detect_time = min(detect_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            buffer, metadata = read_data(userinput_dict)
+            read_time = min(read_time, time.perf_counter() - start)
+
+        size = os.path.getsize(filename)
+        reader = data_formats[metadata["data_format"]]["reader"].__name__
+        print(
+            f"    {name:<26} detected as {metadata['data_format']} ({reader}), "
+            f"detect {detect_time * 1000:.2f} ms, read {read_time * 1000:.1f} ms, "
+            f"{len(buffer) / read_time / 1e6:.2f} M rows/s, {size / read_time / 2**20:.1f} MB/s"
+        )
+        timings[name] = {"detect": detect_time, "read": read_time}
+        if metadata["data_format"] != name:
+            failures.append(f"{name}: detected as {metadata['data_format']}")
+        elif buffer.shape != (len(E), 3) or not np.allclose(
+            buffer[:, :2], np.column_stack([E, I]), rtol=1e-3, atol=1e-3 * abs(I).max()
+        ):
+            failures.append(f"{name}: data read does not match data written")
+    print()
+    return timings, failures
+
+
+def compare_formats(timings, golden, args):
+    failures = []
+    for name, format_times in timings.items():
+        if name not in golden:
+            failures.append(f"{name}: no golden values")
+            continue
+        for step in ["detect", "read"]:
+            time_limit = golden[name][step] * args.time_factor + args.time_slack
+            if format_times[step] > time_limit:
+                failures.append(
+                    f"{name}: {step} time {golden[name][step]:.4f} -> {format_times[step]:.4f} s"
+                )
+    return failures
+
+
+def case_options(filename, output_dir, dif_func, low_memory):
+    return {
+        "data_format": DETECT_FORMAT,
+        "filename": filename,
+        "output_dir": output_dir,
+        "name": "",
+        "cap_check": True,
+        "lin_fit_start": "",
+        "lin_fit_end": "",
+        "fit_range_check": True,
+        "dif_fit_start": "",
+        "dif_fit_end": "",
+        "dif_func": dif_func,
+        "low_memory": low_memory,
+    }
+
+
+# prints the profile of a case and compares it with its golden values, returns any failures
+def check_case(key, profiles, golden_cases, args, result_keys):
+    profiles[key]["results"].pop("name", None)
+    profiles[key]["results"].pop("peak_rss", None)
+    print_profile(key, profiles[key])
+    if key in golden_cases:
+        return compare(key, profiles[key], golden_cases[key], args, result_keys)
+    if not args.update:
+        return [f"{key}: no golden values"]
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--update", action="store_true", help="store results as golden values")
+    parser.add_argument("--golden", default=GOLDEN_FILE, help="golden values json file")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--rtol", type=float, default=1e-4, help="relative tolerance of fit results")
+    parser.add_argument("--atol", type=float, default=1e-6, help="absolute tolerance of fit results")
+    parser.add_argument("--time-factor", type=float, default=2.0, help="allowed slowdown per stage")
+    parser.add_argument("--time-slack", type=float, default=0.05, help="allowed extra seconds per stage")
+    parser.add_argument("--memory-factor", type=float, default=1.5, help="allowed peak memory increase per stage")
+    parser.add_argument("--memory-slack", type=int, default=2**20, help="allowed extra bytes per stage")
+    parser.add_argument("--low-memory", action="store_true", help="read files in low memory mode")
+    args = parser.parse_args()
+
+    golden = {"cases": {}, "formats": {}}
+    if not args.update:
+        with open(args.golden, "r", encoding="utf-8") as file:
+            golden = json.load(file)
+    golden_cases = golden["cases"]
+
+    profiles = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        format_timings, failures = profile_formats(temp_dir, args)
+        if not args.update:
+            failures += compare_formats(format_timings, golden.get("formats", {}), args)
+        for case_name, filename, dif_funcs, low_memory, single_run_stages in benchmark_cases(
+            temp_dir, args
+        ):
+            for dif_func in dif_funcs:
+                userinput_dict = case_options(filename, temp_dir, dif_func, low_memory)
+                key = f"{case_name} {dif_func}"
+                profiles[key] = profile_case(
+                    userinput_dict, args.repeat, single_run_stages=single_run_stages
+                )
+                failures += check_case(key, profiles, golden_cases, args, RESULT_KEYS)
+        for case_name, filename, dif_funcs, chain_couples in multi_couple_cases(temp_dir):
+            for dif_func in dif_funcs:
+                userinput_dict = case_options(filename, temp_dir, dif_func, args.low_memory)
+                userinput_dict.update({"multi_couple": True, "chain_couples": chain_couples})
+                key = f"{case_name} {dif_func}"
+                profiles[key] = profile_case(userinput_dict, args.repeat, run_multi_pipeline)
+                failures += check_case(key, profiles, golden_cases, args, MULTI_RESULT_KEYS)
+
+    if args.update:
+        with open(args.golden, "w", encoding="utf-8") as file:
+            json.dump({"cases": profiles, "formats": format_timings}, file, indent=4)
+        print(f"\nGolden values written to {args.golden}")
+        return
+
+    print(f"\nPeak RSS: {peak_rss() / 2**20:.1f} MB")
+    if failures:
+        print("\nREGRESSIONS")
+        for failure in failures:
+            print(f"    {failure}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
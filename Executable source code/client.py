@@ -0,0 +1,100 @@
+"""
+sends fit jobs to a running fitting server (server.py) and prints the results as JSON lines as
+they complete. Jobs are data file paths given as arguments, or read one per line from stdin if
+no paths are given. Only the standard library is imported so the client starts quickly.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+# unix socket in the temp folder, or a localhost port where unix sockets aren't available
+if hasattr(socket, "AF_UNIX"):
+    DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), "diffusional-fitter.sock")
+else:
+    DEFAULT_ADDRESS = "127.0.0.1:8765"
+
+
+# socket family and address from an address string, host:port for TCP or a unix socket path
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and os.path.sep not in address:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError(f"Unix sockets aren't available, use host:port instead of {address}")
+    return socket.AF_UNIX, address
+
+
+# sends jobs to the server and yields results in the order they complete. Jobs are dicts of
+# fitter options, with "filename" for a data file or "data" for in-memory arrays, and an
+# optional "id" which is returned with the result. Results are dicts with the job's "id" and
+# either "results" as returned by fitter.fitter, or "error"
+def fit(jobs, address=DEFAULT_ADDRESS):
+    family, address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as connection:
+        connection.connect(address)
+
+        # jobs are sent from a thread so results can be read while sending, and the write side
+        # is closed afterwards to tell the server no more jobs are coming
+        def send():
+            with connection.makefile("w", encoding="utf-8") as file:
+                for job in jobs:
+                    file.write(json.dumps(job) + "\n")
+            connection.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        with connection.makefile("r", encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+        sender.join()
+
+
+# parses key=value options, values are read as JSON where possible so numbers and true/false
+# keep their types
+def parse_options(options):
+    parsed = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("filenames", nargs="*", help="data files, read from stdin if none given")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="server socket path or host:port")
+    parser.add_argument("--output-dir", default=None, help="folder for plots and summary files")
+    parser.add_argument("--dif-func", choices=["Cottrellian", "Shoup-Szabo"], default="Cottrellian")
+    parser.add_argument("--no-save", action="store_true", help="return results without saving plots")
+    parser.add_argument(
+        "--option", action="append", default=[], metavar="KEY=VALUE", help="other fitter options"
+    )
+    args = parser.parse_args()
+
+    filenames = args.filenames or (line.strip() for line in sys.stdin if line.strip())
+    options = {"dif_func": args.dif_func, "save": not args.no_save}
+    options.update(parse_options(args.option))
+
+    def jobs():
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            output_dir = args.output_dir or os.path.dirname(filename)
+            yield dict(options, id=filename, filename=filename, output_dir=os.path.abspath(output_dir))
+
+    failed = False
+    for result in fit(jobs(), args.address):
+        print(json.dumps(result), flush=True)
+        failed = failed or "error" in result
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,31 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import stats
-import os
-from library import CV, linear_base_fit, summary_writer, diffusional_fit
+from concurrent.futures import ThreadPoolExecutor
+from library import (
+    CV,
+    find_couples,
+    MAX_DELTA_EP,
+    multi_summary_writer,
+    linear_base_fit,
+    summary_writer,
+    diffusional_fit,
+    FitBudget,
+    NoFitInBudget,
+    reserved_output_name,
+    atomic_open,
+    nearest_index,
+    minmax_downsample,
+    peak_rss,
+)
 
 
-def fitter(userinput_dict):
-    # checks for Cottrellian or Shoup-Szabo option, defines piecewise fitting functions
+def Shoup_Szabo(t, k, t_prime, a):
+    return a + k / np.sqrt(t - t_prime) + 0.2732*a*np.exp(-0.9961*abs(a)/np.sqrt(t - t_prime))
+
+
+# checks for Cottrellian or Shoup-Szabo option, defines piecewise fitting functions
+def fitting_function(userinput_dict, cv, baseline):
     if userinput_dict["dif_func"] == "Cottrellian":
 
         def fitting_func(t, k, t_prime):
@@ -31,9 +50,6 @@ def fitter(userinput_dict):
             )
 
     else:
-        def Shoup_Szabo(t, k, t_prime, a):
-            return a + k / np.sqrt(t - t_prime) + 0.2732*a*np.exp(-0.9961*abs(a)/np.sqrt(t - t_prime))
-
         def fitting_func(t, k, t_prime, a):
             args = (k, t_prime, a)
 
@@ -57,42 +73,82 @@ def fitter(userinput_dict):
                 t, [t <= cv.t_switch_pot, t > cv.t_switch_pot], [SS1, SS2], *args
             )
 
-    # create CV object from selected filename
-    cv = CV(userinput_dict)
+    return fitting_func
+
 
-    # set bounds for diffusional fitting function
+# fitting function for a couple whose baseline is the fitted function of the previous couple, so
+# the diffusional decay of every earlier couple is included
+def chained_fitting_function(userinput_dict, previous_func, previous_popt):
     if userinput_dict["dif_func"] == "Cottrellian":
-        fitting_bounds = ((-np.inf, 0), (np.inf, cv.t_1st_peak))
+
+        def fitting_func(t, k, t_prime):
+            return previous_func(t, *previous_popt) + k / np.sqrt(t - t_prime)
 
     else:
-        fitting_bounds = ((-np.inf, 0, -np.inf), (np.inf, cv.t_1st_peak, np.inf))
 
-    # check for automatic or user-defined linear fit for first peak and capacitance correction
+        def fitting_func(t, k, t_prime, a):
+            return previous_func(t, *previous_popt) + Shoup_Szabo(t, k, t_prime, a)
+
+    return fitting_func
+
+
+# set bounds for diffusional fitting function
+def fitting_bounds(userinput_dict, cv):
+    if userinput_dict["dif_func"] == "Cottrellian":
+        return ((-np.inf, 0), (np.inf, cv.t_1st_peak))
+
+    return ((-np.inf, 0, -np.inf), (np.inf, cv.t_1st_peak, np.inf))
+
+
+# check for automatic or user-defined linear fit for first peak and capacitance correction
+def baseline_fit(cv, userinput_dict, budget=None):
     if userinput_dict["cap_check"]:
         # intial fit
-        baseline, x_reg, y_reg = linear_base_fit(cv, 1, int(0.04 / cv.V_per_index))
+        return linear_base_fit(cv, 1, int(0.04 / cv.V_per_index), budget)
 
-    else:
-        # find nearest values to user defined range
-        left_fit_limit = np.abs(
-            np.array(cv.dataframe["Time"] - float(userinput_dict["lin_fit_start"]))
-        ).argmin()
-        right_fit_limit = np.abs(
-            np.array(cv.dataframe["Time"] - float(userinput_dict["lin_fit_end"]))
-        ).argmin()
-        # use nearest values in linear fit
-        x_reg = np.array(cv.dataframe["Time"].iloc[left_fit_limit:right_fit_limit])
-        y_reg = np.array(cv.dataframe["I"].iloc[left_fit_limit:right_fit_limit])
-        baseline = stats.linregress(x_reg, y_reg)
+    # find nearest values to user defined range
+    time = cv.column("Time")
+    left_fit_limit = nearest_index(time, float(userinput_dict["lin_fit_start"]))
+    right_fit_limit = nearest_index(time, float(userinput_dict["lin_fit_end"]))
+    # use nearest values in linear fit
+    x_reg = np.array(cv.dataframe["Time"].iloc[left_fit_limit:right_fit_limit])
+    y_reg = np.array(cv.dataframe["I"].iloc[left_fit_limit:right_fit_limit])
+    baseline = stats.linregress(x_reg, y_reg)
+    return baseline, x_reg, y_reg
 
-    # perform diffusional fitting
-    popt, x_fit, r_squared = diffusional_fit(
-        cv, userinput_dict, fitting_bounds, fitting_func
-    )
 
+# peak currents measured from the linear and diffusional baselines
+def peak_currents(cv, baseline, fitting_func, popt):
+    Ip1 = cv.forwardpeak_current - (cv.t_1st_peak * baseline.slope + baseline.intercept)
+    Ip2 = cv.backpeak_current - fitting_func(cv.t_2nd_peak, *popt)
+    peak_ratio = abs(round(Ip2 / Ip1, 4))
+    return {"Ip1": Ip1, "Ip2": Ip2, "peak_ratio": peak_ratio}
+
+
+# results of a completed fit, returned for scripted use
+def fit_results(name, peak_dict, baseline, popt, r_squared, budget=None):
+    return {
+        "name": name,
+        "Ip1": float(peak_dict["Ip1"]),
+        "Ip2": float(peak_dict["Ip2"]),
+        "peak_ratio": float(peak_dict["peak_ratio"]),
+        "popt": [float(param) for param in popt],
+        "linear_r_squared": float(baseline.rvalue**2),
+        "r_squared": float(r_squared),
+        "peak_rss": peak_rss(),
+        "budget_limited": None if budget is None else budget.limited_by,
+    }
+
+
+# saves plot and summary file for a completed fit, stages are passed in so results from the
+# preview window can be written without repeating any of the fitting
+def save_fit(
+    cv, userinput_dict, baseline, x_reg, popt, x_fit, r_squared, fitting_func, budget=None
+):
     # PLOTTING
     # arrays for peak lines in plots
-    x_base = np.array(cv.dataframe["Time"][0 : cv.i_1st_peak])
+    time = cv.column("Time")
+    x_base = time[[0, cv.i_1st_peak - 1]]  # straight line, only end points are needed
     x_peak = np.array([cv.t_1st_peak, cv.t_1st_peak])
     y_peak = np.array(
         [cv.t_1st_peak * baseline.slope + baseline.intercept, cv.forwardpeak_current]
@@ -100,9 +156,8 @@ def fitter(userinput_dict):
     x_peak2 = np.array([cv.t_2nd_peak, cv.t_2nd_peak])
     y_peak2 = np.array([fitting_func(cv.t_2nd_peak, *popt), cv.backpeak_current])
 
-    # plot data
-    x = np.array(cv.dataframe["Time"])
-    y = np.array(cv.dataframe["I"])
+    # plot data, downsampled for long files
+    x, y = minmax_downsample(time, cv.column("I"))
 
     # formatting
     plt.rcParams.update({"font.sans-serif": "Arial"})
@@ -118,7 +173,8 @@ def fitter(userinput_dict):
     plt.plot(x, y)
 
     # 1st peak and baseline
-    Ip1 = cv.forwardpeak_current - (cv.t_1st_peak * baseline.slope + baseline.intercept)
+    peak_dict = peak_currents(cv, baseline, fitting_func, popt)
+    Ip1 = peak_dict["Ip1"]
     plt.plot(x_peak, y_peak, linewidth=2, color="black", ls="dotted")
     plt.plot(
         x_base,
@@ -143,8 +199,7 @@ def fitter(userinput_dict):
 
     # 2nd peak and baseline
     plt.plot(x_fit, fitting_func(x_fit, *popt), linewidth=2, color="black")
-    Ip2 = cv.backpeak_current - fitting_func(cv.t_2nd_peak, *popt)
-    y_peak2 = np.array([fitting_func(cv.t_2nd_peak, *popt), cv.backpeak_current])
+    Ip2 = peak_dict["Ip2"]
     plt.text(
         cv.t_2nd_peak,
         -Ip2,
@@ -157,35 +212,351 @@ def fitter(userinput_dict):
     )  # Ip label
 
     # extrapolated baseline
-    extrap_x = np.array(
-        cv.dataframe["Time"].iloc[
-            cv.i_1st_peak + int(0.05 / cv.V_per_index) : cv.i_2nd_peak
-        ]
-    )
     extrap_x = np.linspace(x_fit[0], cv.t_2nd_peak, 100)
     plt.plot(
         extrap_x, fitting_func(extrap_x, *popt), linewidth=2, color="black", ls="dotted"
     )
     plt.plot(x_peak2, y_peak2, linewidth=2, ls="dotted", color="black")
 
-    # peak ratio calculation and creation of dictionary for summary report
-    peak_ratio = abs(round(Ip2 / Ip1, 4))
-    plt.text(x_scaling * 0.25, cv.backpeak_current, f"Peak ratio: {peak_ratio}")
-    peak_dict = {"Ip1": Ip1, "Ip2": Ip2, "peak_ratio": peak_ratio}
+    # peak ratio
+    plt.text(
+        x_scaling * 0.25, cv.backpeak_current, f"Peak ratio: {peak_dict['peak_ratio']}"
+    )
 
-    # check for existing files and increment suffix number to prevent overwriting files
+    # reserve an unused name to prevent overwriting files
     if userinput_dict["name"] == "":
         name = "Plot"
     else:
         name = userinput_dict["name"]
-    name_suffix = 2
-    og_name = name
-    while os.path.exists(f"{userinput_dict['output_dir']}/{name}.txt"):
-        name = og_name + f" {name_suffix}"
-        name_suffix += 1
 
     # save plot and summary file
-    plt.savefig(f"{userinput_dict['output_dir']}/{name}.png", format="png", dpi=300)
-    summary_writer(
-        name, cv, userinput_dict, popt, baseline, peak_dict, x_reg, x_fit, r_squared
+    with reserved_output_name(userinput_dict["output_dir"], name) as name:
+        try:
+            with atomic_open(f"{userinput_dict['output_dir']}/{name}.png", "wb") as file:
+                plt.savefig(file, format="png", dpi=300)
+        finally:
+            plt.close()
+        summary_writer(
+            name, cv, userinput_dict, popt, baseline, peak_dict, x_reg, x_fit, r_squared, budget
+        )
+    return name, peak_dict
+
+
+# diffusional fit of one couple, returns the fit with the couple it belongs to, or None if the
+# budget ran out before a fit was found
+def fit_couple(couple, userinput_dict, fitting_func, budget=None):
+    try:
+        popt, x_fit, r_squared = diffusional_fit(
+            couple, userinput_dict, fitting_bounds(userinput_dict, couple), fitting_func, budget
+        )
+    except NoFitInBudget:
+        return None
+    return {
+        "couple": couple,
+        "fitting_func": fitting_func,
+        "popt": popt,
+        "x_fit": x_fit,
+        "r_squared": r_squared,
+    }
+
+
+# time slots the fits of a file run in when fitting couples, the linear fit, then each couple in
+# turn if chained or all at once otherwise, then the return tails at once
+def time_slots(couples, userinput_dict):
+    if userinput_dict.get("chain_couples", True):
+        return len(couples) + 2
+    return 3
+
+
+# fits the diffusional decay of each couple. Chained couples are fitted in order, each on top of
+# the fit of the previous couple. Otherwise couples are independent, each fitted on the linear
+# baseline, and are fitted concurrently from the shared CV data. The return tails only depend on
+# the fit of their own couple so are always fitted concurrently. Each fit is given a share of the
+# budget, couples from the first which can't be fitted within their share are left out as the
+# forward peak of each couple is measured from the fit of the one before
+def fit_couples(couples, userinput_dict, baseline, budget=None):
+    if budget is None:
+        budget = FitBudget(userinput_dict)
+    fits_left = 2 * len(couples) - 1  # couples and the return tails of all but the last
+    time_slots_left = time_slots(couples, userinput_dict) - 1  # the linear fit is done
+    with ThreadPoolExecutor(userinput_dict.get("workers")) as executor:
+        if userinput_dict.get("chain_couples", True):
+            couple_fits = []
+            fitting_func = fitting_function(userinput_dict, couples[0], baseline)
+            for couple in couples:
+                if couple_fits:
+                    previous = couple_fits[-1]
+                    fitting_func = chained_fitting_function(
+                        userinput_dict, previous["fitting_func"], previous["popt"]
+                    )
+                share = budget.share(fits_left, time_slots_left)
+                fits_left -= 1
+                time_slots_left -= 1
+                couple_fits.append(fit_couple(couple, userinput_dict, fitting_func, share))
+                if couple_fits[-1] is None:
+                    break
+        else:
+            shares = [budget.share(fits_left, time_slots_left) for couple in couples]
+            couple_fits = list(
+                executor.map(
+                    lambda couple, share: fit_couple(
+                        couple,
+                        userinput_dict,
+                        fitting_function(userinput_dict, couple, baseline),
+                        share,
+                    ),
+                    couples,
+                    shares,
+                )
+            )
+        if None in couple_fits:
+            couple_fits = couple_fits[: couple_fits.index(None)]
+        if not couple_fits:
+            raise NoFitInBudget(f"Fit budget ({budget.limited_by}) ran out before a fit was found")
+
+        # tail windows are short, so tails are fitted with the Cottrellian function only. Return
+        # peaks of couples whose tail can't be fitted within the budget are measured from the
+        # couple's own fit
+        tail_dict = dict(userinput_dict, dif_func="Cottrellian")
+        shares = [budget.share(len(couple_fits) - 1, 1) for fit in couple_fits[:-1]]
+        tail_fits = executor.map(
+            lambda fit, share: fit_couple(
+                fit["couple"].tail,
+                tail_dict,
+                chained_fitting_function(tail_dict, fit["fitting_func"], fit["popt"]),
+                share,
+            ),
+            couple_fits[:-1],
+            shares,
+        )
+        for fit, tail_fit in zip(couple_fits, list(tail_fits) + [None]):
+            fit["tail"] = tail_fit
+
+    # forward peaks are measured from the linear baseline for the first couple and from the fit
+    # of the previous couple for the others, return peaks from the couple's own fit, or its
+    # return tail fit if it has one
+    for i, fit in enumerate(couple_fits):
+        couple = fit["couple"]
+        if i == 0:
+            base_current = couple.t_1st_peak * baseline.slope + baseline.intercept
+        else:
+            previous = couple_fits[i - 1]
+            base_current = previous["fitting_func"](couple.t_1st_peak, *previous["popt"])
+        return_fit = fit["tail"] or fit
+        fit["base_current"] = base_current
+        fit["back_base_current"] = return_fit["fitting_func"](couple.t_2nd_peak, *return_fit["popt"])
+        Ip1 = couple.forwardpeak_current - base_current
+        Ip2 = couple.backpeak_current - fit["back_base_current"]
+        fit["peak_dict"] = {"Ip1": Ip1, "Ip2": Ip2, "peak_ratio": abs(round(Ip2 / Ip1, 4))}
+    return couple_fits
+
+
+# saves one plot and summary file with the fits of all couples
+def save_multi_fit(
+    cv,
+    userinput_dict,
+    baseline,
+    x_reg,
+    couple_fits,
+    budget=None,
+    couples_found=None,
+    unpaired=(),
+):
+    time = cv.column("Time")
+    x, y = minmax_downsample(time, cv.column("I"))
+
+    # formatting
+    plt.rcParams.update({"font.sans-serif": "Arial"})
+    plt.figure(dpi=300)
+    plt.title(userinput_dict["name"])
+    max_current = cv.dataframe["I"].max()
+    min_current = cv.dataframe["I"].min()
+    y_scaling = max_current - min_current
+    x_scaling = cv.dataframe["Time"].iloc[-1]
+    plt.ylim(min_current - 0.1 * y_scaling, max_current + 0.1 * y_scaling)
+    plt.ylabel(f"I ({cv.scale_prefix}A)")
+    plt.xlabel(f"Time (s)")
+    plt.plot(x, y)
+
+    # linear baseline of the first couple
+    x_base = time[[0, couple_fits[0]["couple"].i_1st_peak - 1]]
+    plt.plot(
+        x_base,
+        x_base * baseline.slope + baseline.intercept,
+        linewidth=2,
+        color="black",
+        ls="dotted",
     )
+    plt.plot(x_reg, x_reg * baseline.slope + baseline.intercept, linewidth=2, color="black")
+
+    # fit, extrapolated fit and peak lines of each couple in its own colour
+    for fit in couple_fits:
+        couple, fitting_func, popt = fit["couple"], fit["fitting_func"], fit["popt"]
+        peak_dict = fit["peak_dict"]
+        color = f"C{couple.number}"
+        plt.plot(
+            fit["x_fit"],
+            fitting_func(fit["x_fit"], *popt),
+            linewidth=2,
+            color=color,
+            label=f"Couple {couple.number}, R\u00b2: {round(fit['r_squared'], 6)}, "
+            f"peak ratio: {peak_dict['peak_ratio']}",
+        )
+        if fit["tail"] is None:
+            extrap_x = np.linspace(fit["x_fit"][0], couple.t_2nd_peak, 100)
+            plt.plot(extrap_x, fitting_func(extrap_x, *popt), linewidth=2, color=color, ls="dotted")
+        else:
+            # decay extrapolated to the foot of the return peaks, then the return tail fit
+            tail = fit["tail"]
+            extrap_x = np.linspace(fit["x_fit"][0], tail["x_fit"][0], 100)
+            plt.plot(extrap_x, fitting_func(extrap_x, *popt), linewidth=2, color=color, ls="dotted")
+            plt.plot(
+                tail["x_fit"],
+                tail["fitting_func"](tail["x_fit"], *tail["popt"]),
+                linewidth=2,
+                color=color,
+                ls="dashed",
+            )
+            extrap_x = np.linspace(tail["x_fit"][-1], couple.t_2nd_peak, 20)
+            plt.plot(
+                extrap_x,
+                tail["fitting_func"](extrap_x, *tail["popt"]),
+                linewidth=2,
+                color=color,
+                ls="dotted",
+            )
+        plt.plot(
+            [couple.t_1st_peak, couple.t_1st_peak],
+            [fit["base_current"], couple.forwardpeak_current],
+            linewidth=2,
+            color=color,
+            ls="dotted",
+        )
+        plt.plot(
+            [couple.t_2nd_peak, couple.t_2nd_peak],
+            [fit["back_base_current"], couple.backpeak_current],
+            linewidth=2,
+            color=color,
+            ls="dotted",
+        )
+        plt.text(
+            couple.t_1st_peak + 0.02 * x_scaling,
+            couple.forwardpeak_current,
+            f"{round(peak_dict['Ip1'], 1)} {cv.scale_prefix}A",
+            color=color,
+        )
+        plt.text(
+            couple.t_2nd_peak + 0.02 * x_scaling,
+            couple.backpeak_current,
+            f"{round(peak_dict['Ip2'], 1)} {cv.scale_prefix}A",
+            color=color,
+        )
+    plt.legend(fontsize="small")
+
+    # reserve an unused name to prevent overwriting files
+    if userinput_dict["name"] == "":
+        name = "Plot"
+    else:
+        name = userinput_dict["name"]
+
+    # save plot and summary file
+    with reserved_output_name(userinput_dict["output_dir"], name) as name:
+        try:
+            with atomic_open(f"{userinput_dict['output_dir']}/{name}.png", "wb") as file:
+                plt.savefig(file, format="png", dpi=300)
+        finally:
+            plt.close()
+        multi_summary_writer(
+            name,
+            cv,
+            userinput_dict,
+            baseline,
+            x_reg,
+            couple_fits,
+            budget,
+            couples_found,
+            unpaired,
+        )
+    return name
+
+
+# fits every redox couple of a voltammogram from a single read of the data file, returns a list
+# of results with one entry per couple
+def multi_fitter(userinput_dict):
+    budget = FitBudget(userinput_dict)
+    cv = CV(userinput_dict)
+    couples, unpaired = find_couples(
+        cv,
+        userinput_dict.get("min_peak_prominence", 0.1),
+        userinput_dict.get("max_delta_Ep", MAX_DELTA_EP),
+    )
+
+    # a single manual diffusional fit range can't apply to every couple
+    userinput_dict = dict(userinput_dict, fit_range_check=True)
+    baseline, x_reg, y_reg = baseline_fit(
+        couples[0], userinput_dict, budget.share(1, time_slots(couples, userinput_dict))
+    )
+    couple_fits = fit_couples(couples, userinput_dict, baseline, budget)
+    budget.finish()
+    name = None
+    if userinput_dict.get("save", True):
+        name = save_multi_fit(
+            cv, userinput_dict, baseline, x_reg, couple_fits, budget, len(couples), unpaired
+        )
+
+    results = []
+    for fit in couple_fits:
+        couple = fit["couple"]
+        couple_results = fit_results(
+            name, fit["peak_dict"], baseline, fit["popt"], fit["r_squared"], budget
+        )
+        couple_results.update(
+            {
+                "couple": couple.number,
+                "couples_found": len(couples),
+                "unpaired_peaks": [(sweep, float(E)) for sweep, E in unpaired],
+                "E_half": float(couple.E_half),
+                "delta_Ep": float(couple.delta_Ep),
+                "tail_popt": None,
+                "tail_r_squared": None,
+            }
+        )
+        if fit["tail"] is not None:
+            couple_results.update(
+                {
+                    "tail_popt": [float(param) for param in fit["tail"]["popt"]],
+                    "tail_r_squared": float(fit["tail"]["r_squared"]),
+                }
+            )
+        results.append(couple_results)
+    return results
+
+
+def fitter(userinput_dict):
+    if userinput_dict.get("multi_couple", False):
+        return multi_fitter(userinput_dict)
+
+    # the time budget covers reading the file as well as fitting
+    budget = FitBudget(userinput_dict)
+
+    # create CV object from selected filename
+    cv = CV(userinput_dict)
+
+    # the linear fit is given half of the time left so the diffusional fit has time to run
+    baseline, x_reg, y_reg = baseline_fit(cv, userinput_dict, budget.share(1, 2))
+    fitting_func = fitting_function(userinput_dict, cv, baseline)
+
+    # perform diffusional fitting
+    popt, x_fit, r_squared = diffusional_fit(
+        cv, userinput_dict, fitting_bounds(userinput_dict, cv), fitting_func, budget
+    )
+    budget.finish()
+
+    # plot and summary are optional for scripted use, results are returned either way
+    if userinput_dict.get("save", True):
+        name, peak_dict = save_fit(
+            cv, userinput_dict, baseline, x_reg, popt, x_fit, r_squared, fitting_func, budget
+        )
+    else:
+        name, peak_dict = None, peak_currents(cv, baseline, fitting_func, popt)
+    return fit_results(name, peak_dict, baseline, popt, r_squared, budget)
@@ -15,6 +15,8 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtGui import QIcon
 import fitter
+from library import data_formats, detect_format, DETECT_FORMAT
+from preview import FitPreview
 import sys, os
 
 
@@ -36,14 +38,7 @@ def main():
     # Selection for input file format
     layout.addRow(QLabel("Select data format"))
     format_selector = QComboBox()
-    format_selector.addItems(
-        [
-            "Template CSV file",
-            "CH Instruments text file",
-            "Nova ASCII export",
-            "PSTrace CSV export",
-        ]
-    )
+    format_selector.addItems([DETECT_FORMAT] + list(data_formats))
     layout.addRow(format_selector)
     layout.addRow(QLabel(""))  # empty row for spacing
 
@@ -66,6 +61,11 @@ def main():
     hbox_dif_selection.addWidget(Cottrell_button)
     hbox_dif_selection.addWidget(SS_button)
     layout.addRow(hbox_dif_selection)
+
+    # fit every redox couple in the voltammogram
+    multi_couple_checkbox = QCheckBox()
+    multi_couple_checkbox.setText("Multiple redox couples")
+    layout.addRow(multi_couple_checkbox)
     layout.addRow(QLabel(""))  # empty row for spacing
 
     # capacitance correction
@@ -99,11 +99,13 @@ def main():
     name_input = QLineEdit()
     layout.addRow("Optional: name for plot and summary", name_input)
 
-    # run/about buttons
+    # run/preview/about buttons
     hbox_run_about_buttons = QHBoxLayout()
     run_button = QPushButton("Run")
+    preview_button = QPushButton("Preview")
     about_button = QPushButton("About")
     hbox_run_about_buttons.addWidget(run_button)
+    hbox_run_about_buttons.addWidget(preview_button)
     hbox_run_about_buttons.addWidget(about_button)
     layout.addRow(hbox_run_about_buttons)
 
@@ -133,7 +135,8 @@ def main():
         alert.exec_()
         return
 
-    def run_button_clicked():
+    # returns dict of user inputs, or None after alerting the user to an invalid input
+    def read_userinput():
         # preparation of arguments and error checking
         data_format = format_selector.currentText()
         source = l1.text().replace("Data: ", "")
@@ -163,8 +166,21 @@ def main():
             "dif_fit_start": dif_fit_start,
             "dif_fit_end": dif_fit_end,
             "dif_func": dif_func,
+            "multi_couple": multi_couple_checkbox.isChecked(),
         }
 
+        # detect data format from file contents so PSTrace data is recognised below
+        if data_format == DETECT_FORMAT and l1.text() != "Data:":
+            try:
+                data_format = detect_format(source)
+            except (OSError, ValueError):
+                alert = QMessageBox()
+                alert.setWindowTitle("Error")
+                alert.setText("Data format not recognised, please select the data format")
+                alert.exec_()
+                return
+            userinput_dict.update({"data_format": data_format})
+
         # ask for scan rate in case of PS Trace data
         if data_format == "PSTrace CSV export":
             try:
@@ -181,8 +197,8 @@ def main():
                 alert.exec_()
                 return
 
-        # error management for diffusional fit range
-        if not fit_range_check:
+        # error management for diffusional fit range, ranges are automatic for multiple couples
+        if not fit_range_check and not userinput_dict["multi_couple"]:
             try:
                 dif_fit_start = float(dif_fit_start)
                 dif_fit_end = float(dif_fit_end)
@@ -225,6 +241,13 @@ def main():
             alert.exec_()
             return
 
+        return userinput_dict
+
+    def run_button_clicked():
+        userinput_dict = read_userinput()
+        if userinput_dict is None:
+            return
+
         # run fitter script
         try:
             fitter.fitter(userinput_dict)
@@ -241,6 +264,46 @@ def main():
         alert.setText("Program ran without errors")
         alert.exec_()
 
+    def preview_button_clicked():
+        userinput_dict = read_userinput()
+        if userinput_dict is None:
+            return
+        if userinput_dict["multi_couple"]:
+            alert = QMessageBox()
+            alert.setWindowTitle("Error")
+            alert.setText("Preview is only available for single redox couples")
+            alert.exec_()
+            return
+
+        # open preview window, reference kept on main window so it isn't garbage collected
+        try:
+            window.preview = FitPreview(userinput_dict, on_save=preview_saved)
+        except:
+            alert = QMessageBox()
+            alert.setWindowTitle("Error")
+            alert.setText("Something went wrong.")
+            alert.exec_()
+            return
+        window.preview.setWindowIcon(QIcon(application_path + "/icon.ico"))
+        window.preview.show()
+
+    # copies ranges chosen in the preview window back to the main window
+    def preview_saved(userinput_dict):
+        cap_checkbox.setChecked(userinput_dict["cap_check"])
+        fit_range_box.setChecked(userinput_dict["fit_range_check"])
+        if not userinput_dict["cap_check"]:
+            linear_fit_start_input.setText(f"{userinput_dict['lin_fit_start']:.4g}")
+            linear_fit_end_input.setText(f"{userinput_dict['lin_fit_end']:.4g}")
+        if not userinput_dict["fit_range_check"]:
+            left_fit_range_input.setText(f"{userinput_dict['dif_fit_start']:.4g}")
+            right_fit_range_input.setText(f"{userinput_dict['dif_fit_end']:.4g}")
+
+        # alert message on success
+        alert = QMessageBox()
+        alert.setWindowTitle("Success")
+        alert.setText("Program ran without errors")
+        alert.exec_()
+
     def checkbox_logic():
         # linear capacitance fit
         if cap_checkbox.isChecked():
@@ -263,6 +326,7 @@ def main():
     fit_range_box.stateChanged.connect(checkbox_logic)
     about_button.clicked.connect(about_button_clicked)
     run_button.clicked.connect(run_button_clicked)
+    preview_button.clicked.connect(preview_button_clicked)
     window.setLayout(layout)
     window.show()
     app.exec_()
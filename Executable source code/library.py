@@ -1,194 +1,555 @@
 import pandas as pd
 import numpy as np
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
 from scipy.signal import find_peaks
 from scipy.optimize import curve_fit
 from scipy import stats
 
 """
 reads data from CV data files generated by various potentiostat programs and returns 
-pandas dataframe with potential, current, and time columns
+potential, current, and time columns
 """
 
 
-def CV_reader(userinput_dict):
-    if userinput_dict["data_format"] == "CH Instruments text file":
-        with open(userinput_dict["filename"], "r", encoding="utf-8") as file:
-            lines = file.readlines()
-            counter = 0
-            for line in lines:
-                if line.count("Scan Rate (V/s) =") == 1:
-                    rate_char = line.find("=") + 2
-                    scan_rate = float(line[rate_char:])
-
-                if line.count("Sample Interval (V)") == 1:
-                    interval_char = line.find("=") + 2
-                    V_per_index = float(line[interval_char:])
-
-                # find header line and detect delimiter
-                if line.count("Potential/V") == 1:
-                    header_lines = counter
-                    separator_char = line.find("V") + 1
-                    separator = repr(line[separator_char]).strip("'")
-                counter += 1
-
-        df = pd.read_csv(
-            userinput_dict["filename"], skiprows=header_lines, sep=separator
-        )
-        df.columns = ["E", "I"]
-        time = df.index * V_per_index / scan_rate
-        df["Time"] = time
-        return df
-
-    if userinput_dict["data_format"] == "Nova ASCII export":
-        # use pandas drop and rename to tidy df
-        df = pd.read_csv(userinput_dict["filename"])
-        # remove subsequent scans in case they're accidently included and tidy df
-        df = df[df["Scan"] == 1]
-        df = df.drop(
-            columns=[
-                "WE(1).Potential (V)",
-                "Scan",
-                "Index",
-                "Q+",
-                "Q-",
-                "Current range",
+# reads scan rate, sample interval, header line number and delimiter from a CH Instruments text
+# file, stopping at the header line so the data itself isn't read
+def CHI_header(filename):
+    with open(filename, "r", encoding="utf-8") as file:
+        for counter, line in enumerate(file):
+            if line.count("Scan Rate (V/s) =") == 1:
+                rate_char = line.find("=") + 2
+                scan_rate = float(line[rate_char:])
+
+            if line.count("Sample Interval (V)") == 1:
+                interval_char = line.find("=") + 2
+                V_per_index = float(line[interval_char:])
+
+            # find header line and detect delimiter
+            if line.count("Potential/V") == 1:
+                separator_char = line.find("V") + 1
+                separator = repr(line[separator_char]).strip("'")
+                return scan_rate, V_per_index, counter, separator
+
+
+# potential change per data point, rounded to 3 decimal places or to 3 significant figures for
+# sub-mV intervals which would round to 0
+def potential_interval(potential):
+    i_max, i_min = np.argmax(potential), np.argmin(potential)
+    interval = float((potential[i_max] - potential[i_min]) / (i_max - i_min))
+    return abs(round(interval, 3) or float(f"{interval:.3g}"))
+
+
+# reads scan rate from the first line of a template file
+def template_scan_rate(filename):
+    with open(filename, "r", encoding="utf-8") as file:
+        line = file.readline()
+        rate_char = line.find(",")
+        return float(line[rate_char + 1 :])
+
+
+# peak resident memory of this process in bytes
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        # windows has no resource module, use the peak working set size instead
+        import ctypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong)] + [
+                (field, ctypes.c_size_t)
+                for field in [
+                    "PeakWorkingSetSize",
+                    "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage",
+                    "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage",
+                    "QuotaNonPagedPoolUsage",
+                    "PagefileUsage",
+                    "PeakPagefileUsage",
+                ]
             ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters),
+            counters.cb,
         )
-        df = df.rename(
-            columns={
-                "Potential applied (V)": "E",
-                "Time (s)": "Time",
-                "WE(1).Current (A)": "I",
-            }
-        )
-        # correction for t_0 not == 0
-        df["Time"] = df["Time"] - df["Time"][0]
-        return df
-
-    if userinput_dict["data_format"] == "PSTrace CSV export":
-        # read in data to dataframe
-        df = pd.read_csv(userinput_dict["filename"], header=4, encoding="utf-16_le")
-        df.columns = ["E", "I"]
-        # remove byte order mark and convert data to float
-        df = df[df["E"] != "\ufeff"]
-        df = df.astype(float)
-
-        # read current header to find current magnitude and convert to A
-        with open(userinput_dict["filename"], "r", encoding="utf-16") as file:
-            lines = file.readlines()
-            scale_char = lines[5].find(",") + 1
-            scaler = lines[5][scale_char]
-        if scaler == "m":
-            df["I"] *= 1e-3
-        if scaler == "µ":
-            df["I"] *= 1e-6
-        if scaler == "n":
-            df["I"] *= 1e-9
-        if scaler == "p":
-            df["I"] *= 1e-12
-
-        # use scanrate from userinput_dict to generate time column
-        V_per_index = abs(
-            round(
-                (df["E"].max() - df["E"].min()) / (df["E"].idxmax() - df["E"].idxmin()),
-                3,
+        return counters.PeakWorkingSetSize
+
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+# counts lines in blocks so the file is never held in memory, used as an upper bound for the
+# number of data rows
+def count_lines(filename):
+    lines = 1
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            lines += block.count(b"\n")
+    return lines
+
+
+# preallocates the E, I and Time buffer for low memory mode. The buffer is memory-mapped to a
+# temporary file if requested, or if it wouldn't fit in the memory budget
+def allocate_buffer(userinput_dict, rows):
+    dtype = np.dtype(userinput_dict.get("dtype", "float64"))
+    buffer_bytes = rows * 3 * dtype.itemsize
+    memory_budget = userinput_dict.get("memory_budget")
+    if userinput_dict.get("memmap", False) or (
+        memory_budget is not None
+        and peak_rss() + buffer_bytes > memory_budget * 2**20
+    ):
+        temp_file = tempfile.TemporaryFile(dir=userinput_dict.get("memmap_dir"))
+        return np.memmap(temp_file, dtype=dtype, mode="w+", shape=(rows, 3), order="F")
+    # column-major so each column is contiguous, as in a dataframe
+    return np.empty((rows, 3), dtype=dtype, order="F")
+
+
+# reads a csv into an array with E, I and Time columns. prepare is passed the dataframe read by
+# pandas, or each chunk of it in low memory mode, and returns a dataframe with potential, current
+# and optionally time columns. Without a time column the row labels are stored in its place, to
+# be scaled to time by read_data
+def read_columns(userinput_dict, prepare, **read_csv_kwargs):
+    if userinput_dict.get("low_memory", False):
+        buffer = allocate_buffer(userinput_dict, count_lines(userinput_dict["filename"]))
+        chunks = (
+            prepare(chunk)
+            for chunk in pd.read_csv(
+                userinput_dict["filename"],
+                chunksize=userinput_dict.get("chunk_size", 100000),
+                **read_csv_kwargs,
             )
         )
-        time = df.index * V_per_index / userinput_dict["scan_rate"]
-        df["Time"] = time
+    else:
+        chunks = [prepare(pd.read_csv(userinput_dict["filename"], **read_csv_kwargs))]
+        buffer = np.empty((len(chunks[0]), 3), order="F")
+
+    n_rows = 0
+    for chunk in chunks:
+        end = n_rows + len(chunk)
+        buffer[n_rows:end, 0] = chunk.iloc[:, 0]
+        buffer[n_rows:end, 1] = chunk.iloc[:, 1]
+        if chunk.shape[1] == 3:
+            buffer[n_rows:end, 2] = chunk.iloc[:, 2]
+        else:
+            buffer[n_rows:end, 2] = chunk.index
+        n_rows = end
+    return buffer[:n_rows]
+
+
+# supported data formats, in the order they are listed in the GUI and tried when detecting the
+# format of a file. Each format has a sniff function, which is passed the first bytes of a file
+# and returns True if the file looks like that format, and a reader function, which returns an
+# array with E, I and Time columns and a dictionary of metadata:
+#   "scan_rate": scan rate in V/s, used to calculate time if the file has no time column
+#   "V_per_index": potential change per data point, calculated from the data if None
+#   "current_unit": unit prefix of the current column, eg. "m" for mA
+#   "time": True if the file has a time column
+data_formats = {}
+
+# data_format value used to detect the format from the file contents
+DETECT_FORMAT = "Detect automatically"
+
+# current unit prefixes converted to A
+UNIT_SCALES = {"m": 1e-3, "µ": 1e-6, "u": 1e-6, "n": 1e-9, "p": 1e-12}
+
+
+# decorator adding a reader function to data_formats
+def data_format(name, sniff):
+    def register(reader):
+        data_formats[name] = {"sniff": sniff, "reader": reader}
+        return reader
+
+    return register
+
+
+# returns the name of the first data format whose sniff function matches the file
+def detect_format(filename):
+    with open(filename, "rb") as file:
+        head = file.read(8192)
+    for name, data_format in data_formats.items():
+        if data_format["sniff"](head):
+            return name
+    raise ValueError(f"Data format of {filename} not recognised")
+
+
+# template files start with the scan rate line
+def template_sniff(head):
+    first_line = head.decode("utf-8", "ignore").lstrip("\ufeff").lower()
+    return first_line.startswith("scan rate (v/s),")
+
+
+@data_format("Template CSV file", sniff=template_sniff)
+def template_reader(userinput_dict):
+    # remove NaN rows and columns in case template file was modified
+    buffer = read_columns(
+        userinput_dict,
+        lambda df: df.dropna(axis=0, how="all").dropna(axis=1, how="all"),
+        skiprows=1,
+        encoding="utf-8",
+        sep=",",
+    )
+    metadata = {
+        "scan_rate": template_scan_rate(userinput_dict["filename"]),
+        "V_per_index": None,
+        "current_unit": "",
+        "time": False,
+    }
+    return buffer, metadata
+
+
+@data_format(
+    "CH Instruments text file",
+    sniff=lambda head: b"Potential/V" in head and b"Scan Rate (V/s)" in head,
+)
+def CHI_reader(userinput_dict):
+    scan_rate, V_per_index, header_lines, separator = CHI_header(
+        userinput_dict["filename"]
+    )
+    buffer = read_columns(
+        userinput_dict, lambda df: df, skiprows=header_lines, sep=separator
+    )
+    metadata = {
+        "scan_rate": scan_rate,
+        "V_per_index": V_per_index,
+        "current_unit": "",
+        "time": False,
+    }
+    return buffer, metadata
+
+
+@data_format(
+    "Nova ASCII export",
+    sniff=lambda head: b"Potential applied (V)" in head and b"WE(1).Current (A)" in head,
+)
+def Nova_reader(userinput_dict):
+    # remove subsequent scans in case they're accidently included
+    buffer = read_columns(
+        userinput_dict,
+        lambda df: df.loc[
+            df["Scan"] == 1, ["Potential applied (V)", "WE(1).Current (A)", "Time (s)"]
+        ],
+    )
+    metadata = {"scan_rate": None, "V_per_index": None, "current_unit": "", "time": True}
+    return buffer, metadata
+
+
+@data_format("PSTrace CSV export", sniff=lambda head: head.startswith(b"\xff\xfe"))
+def PSTrace_reader(userinput_dict):
+    # remove byte order mark and convert data to float
+    buffer = read_columns(
+        userinput_dict,
+        lambda df: df[df.iloc[:, 0] != "\ufeff"].astype(float),
+        header=4,
+        encoding="utf-16_le",
+    )
+
+    # read current header to find current magnitude
+    with open(userinput_dict["filename"], "r", encoding="utf-16") as file:
+        for counter, line in enumerate(file):
+            if counter == 5:
+                scale_char = line.find(",") + 1
+                scaler = line[scale_char]
+                break
+
+    # scan rate is input by the user as it isn't included in the export
+    metadata = {
+        "scan_rate": userinput_dict["scan_rate"],
+        "V_per_index": None,
+        "current_unit": scaler,
+        "time": False,
+    }
+    return buffer, metadata
+
+
+@data_format(
+    "BioLogic EC-Lab text file", sniff=lambda head: head.startswith(b"EC-Lab ASCII FILE")
+)
+def BioLogic_reader(userinput_dict):
+    # header length, scan rate and decimal separator from the header
+    header_lines = None
+    scan_rate = None
+    decimal = None
+    with open(userinput_dict["filename"], "r", encoding="latin-1") as file:
+        for counter, line in enumerate(file):
+            if line.startswith("Nb header lines"):
+                header_lines = int(line.split(":")[1])
+            elif line.startswith("dE/dt unit"):
+                # scan rate is usually given in mV/s
+                if scan_rate is not None and line.split()[-1] == "mV/s":
+                    scan_rate /= 1000
+            elif line.startswith("dE/dt"):
+                # scan rate is only used for reporting as the file has a time column
+                try:
+                    scan_rate = float(line.split()[-1].replace(",", "."))
+                except ValueError:
+                    pass
+            # first data line follows the header
+            elif header_lines is not None and counter == header_lines:
+                decimal = "," if "," in line else "."
+                break
+    if decimal is None:
+        raise ValueError(
+            f"EC-Lab header of {userinput_dict['filename']} not recognised, "
+            "expected 'Nb header lines' followed by the data"
+        )
 
-        return df
+    # keep first cycle only, cycle numbers start at 0 or 1 depending on the EC-Lab version
+    first_cycle = []
+
+    def prepare(df):
+        current_column = "<I>/mA" if "<I>/mA" in df.columns else "I/mA"
+        columns = ["Ewe/V", current_column, "time/s", "cycle number"]
+        missing = [column for column in columns if column not in df.columns]
+        if missing:
+            raise ValueError(f"EC-Lab columns {', '.join(missing)} not found")
+        if not first_cycle:
+            first_cycle.append(df["cycle number"].iloc[0])
+        return df.loc[df["cycle number"] == first_cycle[0], ["Ewe/V", current_column, "time/s"]]
+
+    buffer = read_columns(
+        userinput_dict,
+        prepare,
+        skiprows=header_lines - 1,
+        sep="\t",
+        decimal=decimal,
+        encoding="latin-1",
+    )
+    metadata = {
+        "scan_rate": scan_rate,
+        "V_per_index": None,
+        "current_unit": "m",
+        "time": True,
+    }
+    return buffer, metadata
+
+
+@data_format(
+    "Gamry DTA file",
+    sniff=lambda head: head.startswith(b"EXPLAIN") and b"\nTAG\tCV" in head,
+)
+def Gamry_reader(userinput_dict):
+    # finds the first curve table, its length, the scan rate and the decimal separator
+    scan_rate = None
+    curve_line = None
+    data_rows = 0
+    decimal = None
+    with open(userinput_dict["filename"], "r", encoding="latin-1") as file:
+        for counter, line in enumerate(file):
+            if line.startswith("SCANRATE\t"):
+                # scan rate is given in mV/s
+                scan_rate = float(line.split("\t")[2].replace(",", ".")) / 1000
+            elif curve_line is None and line.startswith("CURVE") and "\tTABLE" in line:
+                curve_line = counter
+            elif curve_line is not None and counter > curve_line + 2:
+                # table rows start with a tab, the table ends at the next curve or block
+                if not line.startswith("\t"):
+                    break
+                if data_rows == 0:
+                    decimal = "," if "," in line else "."
+                data_rows += 1
+    if curve_line is None:
+        raise ValueError(f"CURVE table of {userinput_dict['filename']} not recognised")
+    if data_rows == 0:
+        raise ValueError(f"CURVE table of {userinput_dict['filename']} has no data rows")
+
+    def prepare(df):
+        missing = [column for column in ["Vf", "Im", "T"] if column not in df.columns]
+        if missing:
+            raise ValueError(f"Gamry columns {', '.join(missing)} not found")
+        return df[["Vf", "Im", "T"]]
+
+    # skip the units line below the column headers
+    buffer = read_columns(
+        userinput_dict,
+        prepare,
+        skiprows=list(range(curve_line + 1)) + [curve_line + 2],
+        nrows=data_rows,
+        sep="\t",
+        decimal=decimal,
+        encoding="latin-1",
+    )
+    metadata = {
+        "scan_rate": scan_rate,
+        "V_per_index": None,
+        "current_unit": "",
+        "time": True,
+    }
+    return buffer, metadata
+
+
+# reads a data file with the reader for its data format, returning an array with E, I in A, and
+# Time columns, and the reader's metadata with the name of the data format added
+def read_data(userinput_dict):
+    name = userinput_dict.get("data_format", DETECT_FORMAT)
+    if name == DETECT_FORMAT:
+        name = detect_format(userinput_dict["filename"])
+    buffer, metadata = data_formats[name]["reader"](userinput_dict)
+    metadata["data_format"] = name
+
+    # convert current to A and scale columns in place
+    if metadata["current_unit"] in UNIT_SCALES:
+        buffer[:, 1] *= UNIT_SCALES[metadata["current_unit"]]
+
+    if metadata["time"]:
+        # correction for t_0 not == 0
+        buffer[:, 2] -= buffer[0, 2]
+    else:
+        # use scan rate to calculate time column from row numbers
+        if metadata["V_per_index"] is None:
+            metadata["V_per_index"] = potential_interval(buffer[:, 0])
+        buffer[:, 2] *= metadata["V_per_index"]
+        buffer[:, 2] /= metadata["scan_rate"]
+    return buffer, metadata
 
-    if userinput_dict["data_format"] == "Template CSV file":
-        with open(userinput_dict["filename"], "r", encoding="utf-8") as file:
-            lines = file.readlines()
-            rate_char = lines[0].find(",")
-            scan_rate = float(lines[0][rate_char + 1 :])
 
-        # create df using filename and remove NaN rows and columns in case template file was modified
-        df = pd.read_csv(
-            userinput_dict["filename"], skiprows=1, encoding="utf-8", sep=","
-        )
-        df = df.dropna(axis=0, how="all")
-        df = df.dropna(axis=1, how="all")
-        df.columns = ["E", "I"]
-
-        # calculate V_per_index and use scan_rate to calculate time column
-        V_per_index = abs(
-            round(
-                (df["E"].max() - df["E"].min()) / (df["E"].idxmax() - df["E"].idxmin()),
-                3,
-            )
-        )
-        time = df.index * V_per_index / scan_rate
-        df["Time"] = time
-        return df
+# returns pandas dataframe with potential, current, and time columns, which is a view of the
+# array returned by read_data
+def CV_reader(userinput_dict):
+    buffer, metadata = read_data(userinput_dict)
+    return pd.DataFrame(buffer, columns=["E", "I", "Time"], copy=False)
+
+
+# finds the peaks in current[start:end] with a prominence of at least min_prominence and returns
+# their indices and prominences in time order, sign is 1 for oxidation peaks and -1 for reduction
+# peaks. The search is done on block means of the sweep, then each peak is refined on the raw
+# data around the coarse peak, so noise spikes aren't picked and long files stay fast
+def sweep_peaks(current, start, end, peak_width, sign, min_prominence=0):
+    sweep = current[start:end]
+    step = max(1, peak_width // 4)
+    # reshaping the sweep is a view, so only the decimated array is allocated
+    n_blocks = len(sweep) // step
+    smoothed = sign * sweep[: n_blocks * step].reshape(n_blocks, step).mean(axis=1)
+
+    peaks, peak_props = find_peaks(smoothed, height=0, prominence=min_prominence)
+    indices = []
+    for coarse_peak in peaks * step + step // 2:
+        # refine within one decimation step of the coarse peak
+        left = max(coarse_peak - step, 0)
+        right = min(coarse_peak + step + 1, len(sweep))
+        indices.append(start + left + np.argmax(sign * sweep[left:right]))
+    return indices, peak_props["prominences"]
+
+
+# finds the most prominent peak in current[start:end] and returns its index and prominence
+def sweep_peak(current, start, end, peak_width, sign):
+    peaks, prominences = sweep_peaks(current, start, end, peak_width, sign)
+    if len(peaks) == 0:
+        return None, 0
+    most_prominent = np.argmax(prominences)
+    return peaks[most_prominent], prominences[most_prominent]
+
+
+# index of the switching potential, where the potential change between neighbouring points is
+# smallest, found in blocks to avoid allocating a full length difference array
+def switching_index(potential, block_size=2**16):
+    i_switch_pot, min_difference = 0, 1
+    for start in range(1, len(potential) - 1, block_size):
+        end = min(start + block_size, len(potential) - 1)
+        difference = abs(potential[start + 1 : end + 1] - potential[start - 1 : end - 1])
+        i_min = np.argmin(difference)
+        if difference[i_min] < min_difference:
+            i_switch_pot, min_difference = start + i_min, difference[i_min]
+    return i_switch_pot
 
 
 # creates a CV object with associated summary stats
 class CV:
     def __init__(self, userinput_dict):
 
-        df = CV_reader(userinput_dict)
+        buffer, metadata = read_data(userinput_dict)
+        df = pd.DataFrame(buffer, columns=["E", "I", "Time"], copy=False)
         self.filename = userinput_dict["filename"]
         self.dataframe = df
+        self.buffer = buffer
+        self.data_format = metadata["data_format"]
 
         # assign variables
         self.i_min_pot = df["E"].idxmin()
         self.i_max_pot = df["E"].idxmax()
         self.max_pot = df["E"][self.i_max_pot]
         self.min_pot = df["E"][self.i_min_pot]
-        self.V_per_index = abs(
-            round((self.max_pot - self.min_pot) / (self.i_max_pot - self.i_min_pot), 3)
-        )
+        potential = self.column("E")
+        self.V_per_index = potential_interval(potential)
 
-        peak_width = int(
-            0.03 / self.V_per_index
-        )  # 30 mV peak width used as parameter in find_peaks
+        # finds index and time of switching potential
+        self.i_switch_pot = switching_index(potential)
+        self.t_switch_pot = df["Time"][self.i_switch_pot]
 
-        ox_peaks, ox_peak_props = find_peaks(
-            np.array(df["I"]), width=peak_width, height=0
-        )
+        # automatic diffusional fit ranges end at the switching potential
+        self.i_fit_end = self.i_switch_pot
 
-        red_peaks, red_peak_props = find_peaks(
-            -np.array(df["I"]), width=peak_width, height=0
-        )
+        peak_width = self.peak_width = int(
+            0.03 / self.V_per_index
+        )  # 30 mV peak width used to set the coarse peak search resolution
+
+        # the first peak is searched for on the forward sweep, with the polarity giving the most
+        # prominent peak, and the opposite peak is searched for on the return sweep
+        current = self.column("I")
+        forward_sweep = (0, self.i_switch_pot + 1)
+        return_sweep = (self.i_switch_pot, len(current))
+        i_forward_ox, forward_ox_prominence = sweep_peak(current, *forward_sweep, peak_width, 1)
+        i_forward_red, forward_red_prominence = sweep_peak(current, *forward_sweep, peak_width, -1)
+        if forward_ox_prominence >= forward_red_prominence:
+            self.forward_sign = 1
+            i_ox_peak_current = i_forward_ox
+            i_red_peak_current, _ = sweep_peak(current, *return_sweep, peak_width, -1)
+        else:
+            self.forward_sign = -1
+            i_red_peak_current = i_forward_red
+            i_ox_peak_current, _ = sweep_peak(current, *return_sweep, peak_width, 1)
+        if i_ox_peak_current is None or i_red_peak_current is None:
+            raise ValueError("Oxidation and reduction peaks not found")
 
         # find larger peak for scaling
-        if df["I"][ox_peaks[0]] > abs(df["I"][red_peaks[0]]):
-            scaling_current = df["I"][ox_peaks[0]]
+        if df["I"][i_ox_peak_current] > abs(df["I"][i_red_peak_current]):
+            scaling_current = df["I"][i_ox_peak_current]
         else:
-            scaling_current = abs(df["I"][red_peaks[0]])
+            scaling_current = abs(df["I"][i_red_peak_current])
 
         # current auto-scaling
         if 1 > scaling_current >= 1e-3:
-            df["I"] *= 10**3
+            scale = 10**3
             report_scale_prefix = scale_prefix = "m"
 
         elif 1e-3 > scaling_current >= 1e-6:
-            df["I"] *= 10**6
+            scale = 10**6
             scale_prefix = "\u03BC"
             report_scale_prefix = "u"
 
         elif 1e-6 > scaling_current >= 1e-9:
-            df["I"] *= 10**9
+            scale = 10**9
             report_scale_prefix = scale_prefix = "n"
 
         elif 1e-9 > scaling_current:
-            df["I"] *= 10**12
+            scale = 10**12
             report_scale_prefix = scale_prefix = "p"
 
         self.scale_prefix = scale_prefix
         self.report_scale_prefix = report_scale_prefix
 
+        # the buffer is scaled in place, the dataframe is a view of it
+        buffer[:, 1] *= scale
+
         # oxidation
-        i_ox_peak_current = ox_peaks[0]
         i_min_pot = df["E"].idxmin()
         ox_peak_current = df["I"].iloc[i_ox_peak_current]
         Ep_ox = df["E"].iloc[i_ox_peak_current]
 
         # reduction
-        i_red_peak_current = red_peaks[0]
         i_max_pot = df["E"].idxmax()
         red_peak_current = df["I"].iloc[i_red_peak_current]
         Ep_red = df["E"].iloc[i_red_peak_current]
@@ -231,25 +592,129 @@ class CV:
                 red_peak_current,
             )
 
-        # finds index and time of switching potential
-        difference_array = np.ones(len(df["E"]))
-        i = 1
-        while i < len(df["E"]) - 1:
-            difference_array[i] = (df["E"][i + 1]) - (df["E"][i - 1])
-            i += 1
-        self.i_switch_pot = np.argmin(abs(difference_array))
-        self.t_switch_pot = df["Time"][self.i_switch_pot]
-
         # potential stats
         self.E_half = (Ep_ox + Ep_red) / 2
         self.delta_Ep = abs(Ep_ox - Ep_red)
 
+    # column as a numpy array. The buffer is used directly rather than the dataframe, as numpy
+    # copies read-only arrays such as dataframe views in argmin/argmax
+    def column(self, name):
+        return self.buffer[:, ["E", "I", "Time"].index(name)]
+
     def __str__(self):
         return f"CV class created from following file:\n\t{self.filename}"
 
 
-# performs moving linear fit and returns fit with lowest absolute slope
-def linear_base_fit(CV, start, fit_range):
+# automatic diffusional fit ranges of a couple end this far before the next couple's forward
+# peak, so the rising current of the next couple isn't fitted
+PEAK_FOOT_MARGIN = 0.1
+
+
+# one redox couple of a voltammogram with several couples. Peak attributes are those of the couple
+# and everything else is taken from the whole CV, so the functions used to fit single couples
+# can be used on each couple without copying the data. tail is set by find_couples for couples
+# whose return peak follows the return peaks of later couples
+class Couple:
+    def __init__(self, cv, number, i_forward_peak, i_return_peak, i_fit_end):
+        self.cv = cv
+        self.number = number
+        potential, current, time = cv.column("E"), cv.column("I"), cv.column("Time")
+        self.i_1st_peak, self.i_2nd_peak = i_forward_peak, i_return_peak
+        self.t_1st_peak, self.t_2nd_peak = time[i_forward_peak], time[i_return_peak]
+        self.forwardpeak_current = current[i_forward_peak]
+        self.backpeak_current = current[i_return_peak]
+        self.i_fit_end = i_fit_end
+        self.E_half = (potential[i_forward_peak] + potential[i_return_peak]) / 2
+        self.delta_Ep = abs(potential[i_forward_peak] - potential[i_return_peak])
+        self.tail = None
+
+    def __getattr__(self, name):
+        return getattr(self.cv, name)
+
+    def __str__(self):
+        return f"Couple {self.number} of {self.cv}"
+
+
+# largest separation of the forward and return peaks of a couple, peaks further from any peak of
+# the other sweep are left unpaired
+MAX_DELTA_EP = 0.2
+
+
+# finds every pair of forward and return peaks in one pass over the CV and returns them as
+# couples in forward sweep order, with the potentials of peaks which couldn't be paired as
+# (sweep, E) tuples. Peaks less prominent than min_prominence times the most prominent peak of
+# the same sweep are ignored. Each return peak is paired with the nearest forward peak in
+# potential within max_delta_Ep, closest pairs first, so a couple without a return peak (or
+# forward peak) is left out rather than pairing peaks of different couples
+def find_couples(cv, min_prominence=0.1, max_delta_Ep=MAX_DELTA_EP):
+    current, potential = cv.column("I"), cv.column("E")
+    sweeps = [
+        sweep_peaks(current, 0, cv.i_switch_pot + 1, cv.peak_width, cv.forward_sign),
+        sweep_peaks(current, cv.i_switch_pot, len(current), cv.peak_width, -cv.forward_sign),
+    ]
+    forward_peaks, return_peaks = [
+        [
+            peak
+            for peak, prominence in zip(peaks, prominences)
+            if prominence >= min_prominence * max(prominences)
+        ]
+        for peaks, prominences in sweeps
+    ]
+    separations = sorted(
+        (abs(potential[i_forward] - potential[i_return]), i_forward, i_return)
+        for i_forward in forward_peaks
+        for i_return in return_peaks
+        if abs(potential[i_forward] - potential[i_return]) <= max_delta_Ep
+    )
+    pairs = {}
+    for separation, i_forward, i_return in separations:
+        if i_forward not in pairs and i_return not in pairs.values():
+            pairs[i_forward] = i_return
+    if not pairs:
+        raise ValueError("Oxidation and reduction peaks not found")
+    unpaired = [("forward", potential[i]) for i in forward_peaks if i not in pairs] + [
+        ("return", potential[i]) for i in return_peaks if i not in pairs.values()
+    ]
+
+    # the decay of each couple is fitted up to the foot of the next forward peak, paired or not,
+    # the last is fitted up to the switching potential
+    left_fit_margin = int(0.05 / cv.V_per_index)
+    foot_margin = int(PEAK_FOOT_MARGIN / cv.V_per_index)
+    couples = []
+    for number, i_forward_peak in enumerate(sorted(pairs), 1):
+        later_peaks = [i for i in forward_peaks if i > i_forward_peak]
+        i_fit_end = later_peaks[0] - foot_margin if later_peaks else cv.i_switch_pot
+        check_fit_range(cv, i_forward_peak + left_fit_margin, i_fit_end)
+        couples.append(Couple(cv, number, i_forward_peak, pairs[i_forward_peak], i_fit_end))
+
+    # return peaks of all but the last couple sit on the tail of the return peaks of later
+    # couples, which is fitted like a forward decay from the next couple's return peak to the
+    # foot of the next return peak, paired or not
+    for couple, next_couple in zip(couples, couples[1:]):
+        i_tail_start = next_couple.i_2nd_peak
+        if i_tail_start > couple.i_2nd_peak:
+            raise ValueError(
+                f"Return peaks near {potential[couple.i_2nd_peak]} V and "
+                f"{potential[i_tail_start]} V are in the same order as their forward peaks"
+            )
+        i_fit_end = min(i for i in return_peaks if i > i_tail_start) - foot_margin
+        check_fit_range(cv, i_tail_start + left_fit_margin, i_fit_end)
+        couple.tail = Couple(cv, couple.number, i_tail_start, couple.i_2nd_peak, i_fit_end)
+    return couples, unpaired
+
+
+# raises an error if peaks are too close for an automatic diffusional fit range between them
+def check_fit_range(cv, i_fit_start, i_fit_end):
+    if (i_fit_end - i_fit_start) * cv.V_per_index < 0.03:
+        raise ValueError(
+            f"Peaks near {cv.column('E')[i_fit_start]} V are too close together to fit "
+            "their diffusional decay"
+        )
+
+
+# performs moving linear fit and returns fit with lowest absolute slope, within the time budget
+# if one is given
+def linear_base_fit(CV, start, fit_range, budget=None):
 
     # select initial range and perform initial linear fit
     x_reg = np.array(CV.dataframe["Time"].iloc[start : start + fit_range])
@@ -259,6 +724,9 @@ def linear_base_fit(CV, start, fit_range):
     # perform series of linear fits and keep one with lowest absolute slope
     counter = 1
     while start + fit_range + counter < CV.i_1st_peak:
+        if budget is not None and budget.out_of_time():
+            budget.record_limit("time")
+            break
         new_x = np.array(
             CV.dataframe["Time"].iloc[start + counter : start + fit_range + counter]
         )
@@ -275,6 +743,33 @@ def linear_base_fit(CV, start, fit_range):
     return baseline, x_reg, y_reg
 
 
+# index of the value in a sorted array closest to value, the first index is used for ties
+def nearest_index(sorted_array, value):
+    i = np.searchsorted(sorted_array, value)
+    if i == 0:
+        return 0
+    if i == len(sorted_array) or value - sorted_array[i - 1] <= sorted_array[i] - value:
+        return i - 1
+    return i
+
+
+# min/max downsampled view of x and y for plotting, each of n_bins bins is represented by its
+# minimum and maximum points so peaks and noise envelopes are kept
+def minmax_downsample(x, y, n_bins=5000):
+    if len(y) <= 2 * n_bins:
+        return x, y
+    bin_size = len(y) // n_bins
+    bins = y[: n_bins * bin_size].reshape(n_bins, bin_size)
+    offsets = np.arange(n_bins) * bin_size
+    i_min = offsets + bins.argmin(axis=1)
+    i_max = offsets + bins.argmax(axis=1)
+    # keep the points of each bin in time order, and include the remaining points
+    indices = np.concatenate(
+        [np.sort(np.stack([i_min, i_max], axis=1), axis=1).ravel(), np.arange(n_bins * bin_size, len(y))]
+    )
+    return x[indices], y[indices]
+
+
 # R_squared function used in diffusional fitting
 def R_squared(observed_y, predicted_y):
     residuals = observed_y - predicted_y
@@ -283,23 +778,163 @@ def R_squared(observed_y, predicted_y):
     return 1 - (residuals_ss / total_ss)
 
 
-def diffusional_fit(cv, userinput_dict, fitting_bounds, fitting_func):
+# raised from a tracked fitting function to stop curve_fit once a fit budget runs out
+class BudgetExhausted(Exception):
+    pass
+
+
+# raised when a fit budget runs out before the first fit of a range is found
+class NoFitInBudget(RuntimeError):
+    pass
+
+
+# per-file limits on fitting, from the "time_budget" (s), "evaluation_budget" and
+# "iteration_budget" options, None or missing for no limit. Time is counted from when the budget
+# is created, evaluations are all calls of the fitting function by curve_fit, including those
+# used to estimate the jacobian, and iterations are steps of the automatic fit range search.
+# The linear fit and the fits of each couple are given shares of the budget. limited_by is the
+# first budget that ran out, or None
+class FitBudget:
+    def __init__(self, userinput_dict, parent=None):
+        self.start = time.perf_counter()
+        self.end = None
+        self.time_budget = userinput_dict.get("time_budget")
+        self.evaluation_budget = userinput_dict.get("evaluation_budget")
+        self.iteration_budget = userinput_dict.get("iteration_budget")
+        self.evaluations = 0
+        self.iterations = 0
+        self.limited_by = None
+        self.parent = parent
+        # one lock for the budget of a file and its shares, so checking and counting is atomic
+        self.lock = threading.Lock() if parent is None else parent.lock
+
+    # budget for one of the fits left in the file, with an equal share of the evaluations and
+    # iterations left, and of the time left over the time slots the remaining fits run in (fits
+    # run at once share a slot), so one fit's range search can't use up the budget of the fits
+    # after it. What a share uses is also counted in this budget
+    def share(self, fits_left, time_slots_left):
+        limits = {}
+        if self.time_budget is not None:
+            limits["time_budget"] = max(self.time_budget - self.elapsed(), 0) / time_slots_left
+        if self.evaluation_budget is not None:
+            limits["evaluation_budget"] = (self.evaluation_budget - self.evaluations) // fits_left
+        if self.iteration_budget is not None:
+            limits["iteration_budget"] = (self.iteration_budget - self.iterations) // fits_left
+        return FitBudget(limits, parent=self)
+
+    def is_set(self):
+        return any(
+            budget is not None
+            for budget in [self.time_budget, self.evaluation_budget, self.iteration_budget]
+        )
+
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    # stops the clock once fitting has finished, so saving isn't counted in the reported time
+    def finish(self):
+        self.end = time.perf_counter()
+
+    # evaluations are only counted when there is a time or evaluation budget to check
+    def tracks_evaluations(self):
+        return self.time_budget is not None or self.evaluation_budget is not None
+
+    # this budget and the budgets it is a share of, ending with the budget of the whole file
+    def chain(self):
+        budget = self
+        while budget is not None:
+            yield budget
+            budget = budget.parent
+
+    # the budgets checked by a fit, fits which must find a result are only limited by the
+    # budget of the whole file
+    def limits(self, whole_file=False):
+        return list(self.chain())[-1:] if whole_file else list(self.chain())
+
+    def out_of_time(self, whole_file=False):
+        return any(
+            budget.time_budget is not None and budget.elapsed() > budget.time_budget
+            for budget in self.limits(whole_file)
+        )
+
+    # counts an evaluation or iteration in this budget and the budgets it is a share of,
+    # returns False without counting it if any budget checked has run out
+    def take(self, counter, limit, whole_file=False):
+        with self.lock:
+            for budget in self.limits(whole_file):
+                budget_limit = getattr(budget, limit)
+                if budget_limit is not None and getattr(budget, counter) >= budget_limit:
+                    return False
+            for budget in self.chain():
+                setattr(budget, counter, getattr(budget, counter) + 1)
+        return True
+
+    # records the budget that ran out, in this budget and the budgets it is a share of
+    def record_limit(self, limit):
+        with self.lock:
+            for budget in self.chain():
+                budget.limited_by = budget.limited_by or limit
+
+    def exhaust(self, limit):
+        self.record_limit(limit)
+        raise BudgetExhausted(limit)
+
+    # fitting function which counts its evaluations and stops the fit once the time or
+    # evaluation budget runs out, the function is returned unchanged if neither is set
+    def track(self, fitting_func, whole_file=False):
+        if not self.tracks_evaluations():
+            return fitting_func
+
+        # wraps keeps the signature, which curve_fit uses to count the fitted parameters
+        @wraps(fitting_func)
+        def tracked_func(t, *args):
+            if self.out_of_time(whole_file):
+                self.exhaust("time")
+            if not self.take("evaluations", "evaluation_budget", whole_file):
+                self.exhaust("function evaluations")
+            return fitting_func(t, *args)
+
+        return tracked_func
+
+    # counts a step of the fit range search, returns False once the iteration budget has run out
+    def next_iteration(self):
+        if not self.take("iterations", "iteration_budget"):
+            self.record_limit("range search iterations")
+            return False
+        return True
+
+
+# fits before the first completed fit can't fall back on an earlier fit when the budget runs out
+def first_fit(fitting_func, x_fit, y_fit, fitting_bounds):
+    try:
+        return curve_fit(fitting_func, x_fit, y_fit, bounds=fitting_bounds)
+    except BudgetExhausted as limit:
+        raise NoFitInBudget(f"Fit budget ({limit}) ran out before a fit was found") from None
+
+
+# fits the diffusional decay, within the budget if one is given, otherwise a budget is created
+# from userinput_dict. When a budget runs out the best fit found so far is returned, and
+# budget.limited_by is set. The first fit is counted in a share of the budget but may use
+# whatever is left of the file's budget, so a share only limits the range search
+def diffusional_fit(cv, userinput_dict, fitting_bounds, fitting_func, budget=None):
+    if budget is None:
+        budget = FitBudget(userinput_dict)
+    tracked_func = budget.track(fitting_func)
+    first_func = budget.track(fitting_func, whole_file=True)
+
     # USER DEFINED FITTING RANGE
     if not userinput_dict["fit_range_check"]:
         # find closest time values to those specified by user
-        left_fit_limit = np.abs(
-            np.array(cv.dataframe["Time"] - float(userinput_dict["dif_fit_start"]))
-        ).argmin()
-        right_fit_limit = np.abs(
-            np.array(cv.dataframe["Time"] - float(userinput_dict["dif_fit_end"]))
-        ).argmin()
+        time = cv.column("Time")
+        left_fit_limit = nearest_index(time, float(userinput_dict["dif_fit_start"]))
+        right_fit_limit = nearest_index(time, float(userinput_dict["dif_fit_end"]))
 
         # create arrays for fitting
         x_fit = np.array(cv.dataframe["Time"].iloc[left_fit_limit:right_fit_limit])
         y_fit = np.array(cv.dataframe["I"].iloc[left_fit_limit:right_fit_limit])
 
         # diffusional fitting fitting
-        popt, pcov = curve_fit(fitting_func, x_fit, y_fit, bounds=fitting_bounds)
+        popt, pcov = first_fit(first_func, x_fit, y_fit, fitting_bounds)
 
         # calculate r-squared value
         r_squared = R_squared(y_fit, fitting_func(x_fit, *popt))
@@ -310,30 +945,35 @@ def diffusional_fit(cv, userinput_dict, fitting_bounds, fitting_func):
     # find 50 mV from Ep to use as left end for fitting
     left_fit_margin = int(0.05 / cv.V_per_index)
     left_fit_limit = cv.i_1st_peak + left_fit_margin
-    right_fit_limit = cv.i_switch_pot
+    right_fit_limit = cv.i_fit_end
 
     # perform initial fit and calculate R-squared
     x_fit = np.array(cv.dataframe["Time"].iloc[left_fit_limit:right_fit_limit])
     y_fit = np.array(cv.dataframe["I"].iloc[left_fit_limit:right_fit_limit])
 
     # diffusional fitting
-    popt, pcov = curve_fit(fitting_func, x_fit, y_fit, bounds=fitting_bounds)
+    popt, pcov = first_fit(first_func, x_fit, y_fit, fitting_bounds)
 
     # calculate r-squared value
     r_squared = R_squared(y_fit, fitting_func(x_fit, *popt))
 
-    # shrinking algorithm
+    # shrinking algorithm, stops with the best fit so far if the budget runs out
     counter = 1
-    while (cv.i_switch_pot - counter - left_fit_limit) * cv.V_per_index > 0.03:
+    while (cv.i_fit_end - counter - left_fit_limit) * cv.V_per_index > 0.03:
+        if not budget.next_iteration():
+            break
         new_x = np.array(
-            cv.dataframe["Time"].iloc[left_fit_limit : cv.i_switch_pot - counter]
+            cv.dataframe["Time"].iloc[left_fit_limit : cv.i_fit_end - counter]
         )
         new_y = np.array(
-            cv.dataframe["I"].iloc[left_fit_limit : cv.i_switch_pot - counter]
-        )
-        new_popt, new_pcov = curve_fit(
-            fitting_func, new_x, new_y, bounds=fitting_bounds
+            cv.dataframe["I"].iloc[left_fit_limit : cv.i_fit_end - counter]
         )
+        try:
+            new_popt, new_pcov = curve_fit(
+                tracked_func, new_x, new_y, bounds=fitting_bounds
+            )
+        except BudgetExhausted:
+            break
 
         # calculate r-squared value
         new_r_squared = R_squared(new_y, fitting_func(new_x, *popt))
@@ -352,47 +992,257 @@ def diffusional_fit(cv, userinput_dict, fitting_bounds, fitting_func):
     return popt, x_fit, r_squared
 
 
-# writes summary txt file after fitting
-def summary_writer(
-    name, cv, userinput_dict, popt, baseline, peak_dict, x_reg, x_fit, r_squared
-):
+# reserves an unused name in the output folder by exclusively creating its summary file, so
+# runs writing to the same folder at once can never pick the same name or overwrite outputs
+def reserve_output_name(output_dir, name):
+    # scan the folder once for the suffixes taken rather than testing each name, a suffix of 1
+    # is the name without a number
+    taken = set()
+    suffix_pattern = re.compile(rf"{re.escape(name)}(?: (\d+))?\.txt")
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            match = suffix_pattern.fullmatch(entry.name)
+            if match:
+                taken.add(int(match.group(1) or 1))
+
+    # the first free name is used, exclusive create fails if another process took the name
+    # since the scan
+    suffix = 1
+    while True:
+        if suffix not in taken:
+            reserved_name = name if suffix == 1 else f"{name} {suffix}"
+            try:
+                fd = os.open(
+                    f"{output_dir}/{reserved_name}.txt", os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+            except FileExistsError:
+                pass
+            else:
+                os.close(fd)
+                return reserved_name
+        suffix += 1
+
+
+# reserves an output name for writing the outputs of a fit, if writing fails the outputs
+# written and the reserved summary file are removed so the name is free for the next run
+@contextmanager
+def reserved_output_name(output_dir, name, extensions=("png", "txt")):
+    name = reserve_output_name(output_dir, name)
+    paths = [f"{output_dir}/{name}.{extension}" for extension in extensions]
+    # files left by other programs under the name aren't removed
+    existing = {path for path in paths if not path.endswith(".txt") and os.path.exists(path)}
+    try:
+        yield name
+    except BaseException:
+        for path in paths:
+            if path not in existing and os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+# opens a temporary file next to path which replaces path once writing has finished, so a
+# crash never leaves a partially written output
+@contextmanager
+def atomic_open(path, mode="w"):
+    temp_path = f"{os.path.dirname(path) or '.'}/.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, mode.replace("w", "x")) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# diffusional fitting function used, as written in summary files
+def diffusional_function(userinput_dict):
     if userinput_dict["dif_func"] == "Cottrellian":
-        fitted_param_string = (
-            f"k = {popt[0]} {cv.report_scale_prefix}C / s^(1/2)\nt' = {popt[1]} s\n"
-        )
-        fitting_func_string = f"Fitting function: k/sqrt(t-t') + {baseline.slope} + {baseline.intercept}*t\n"
+        return "k/sqrt(t-t')"
+    return "a + k/sqrt(t-t') + 0.2732 * a * exp[(-0.9961 * |a|) / sqrt(t-t')]"
+
 
+# fitted diffusional parameters with units, as written in summary files
+def fitted_parameters(cv, userinput_dict, popt):
+    if userinput_dict["dif_func"] == "Cottrellian":
+        return f"k = {popt[0]} {cv.report_scale_prefix}C / s^(1/2)\nt' = {popt[1]} s\n"
+    return f"k = {popt[0]} {cv.report_scale_prefix}C / s^(1/2)\nt' = {popt[1]} s\na = {popt[2]} {cv.report_scale_prefix}A\n"
+
+
+# peak memory and memory budget section of summary files, written in low memory mode
+def memory_summary(userinput_dict):
+    if not userinput_dict.get("low_memory", False):
+        return []
+    summary = ["\nMEMORY\n", f"Peak memory: {peak_rss() / 2**20:.1f} MB\n"]
+    if userinput_dict.get("memory_budget") is not None:
+        summary.append(f"Memory budget: {userinput_dict['memory_budget']} MB")
+        if peak_rss() > userinput_dict["memory_budget"] * 2**20:
+            summary.append(" (exceeded)")
+        summary.append("\n")
+    return summary
+
+
+# summary lines for the fit budget, only written if a budget was set
+def budget_summary(budget):
+    if budget is None or not budget.is_set():
+        return []
+    summary = ["\nBUDGET\n"]
+    if budget.limited_by is None:
+        summary.append("Fit completed within budget\n")
     else:
-        fitted_param_string = f"k = {popt[0]} {cv.report_scale_prefix}C / s^(1/2)\nt' = {popt[1]} s\na = {popt[2]} {cv.report_scale_prefix}A\n"
-        fitting_func_string = f"Fitting function: a + k/sqrt(t-t') + 0.2732 * a * exp[(-0.9961 * |a|) / sqrt(t-t')] + {baseline.slope} + {baseline.intercept}*t\n"
-
-    with open(f"{userinput_dict['output_dir']}/{name}.txt", "w") as summary:
-        summary.write("DIFFUSIONAL FITTER SUMMARY\n")
-        summary.write(f"File: {userinput_dict['filename']}\n")
-        summary.write(
-            f"Delta Ep: {cv.delta_Ep} V, Ip1: {peak_dict['Ip1']} {cv.report_scale_prefix}A, Ip2: {peak_dict['Ip2']} {cv.report_scale_prefix}A, peak ratio: {peak_dict['peak_ratio']}\n\n"
+        summary.append(
+            f"Fit limited by budget: {budget.limited_by} ran out, the best fit found is reported\n"
         )
-
-        summary.write("LINEAR FIT (Forward peak baseline)\n")
-        if userinput_dict["cap_check"]:
-            summary.write("Fitting range selection: automatic\n")
-        else:
-            summary.write("Fitting range selection: manual\n")
-        summary.write(f"Linear fit range: {x_reg[0]} - {x_reg[len(x_reg)-1]} s\n")
-        summary.write(f"Fitting function: slope*t + intercept\n")
-        summary.write(
-            f"slope: {str(baseline.slope)} {cv.report_scale_prefix}A / s\nintercept: {str(baseline.intercept)} {cv.report_scale_prefix}A\nR-squared: {str(baseline.rvalue**2)}\n\n"
+    budgets = [("Time", f"{budget.elapsed():.3f} s", budget.time_budget)]
+    if budget.tracks_evaluations():
+        budgets.append(("Function evaluations", budget.evaluations, budget.evaluation_budget))
+    budgets.append(("Range search iterations", budget.iterations, budget.iteration_budget))
+    for label, used, limit in budgets:
+        summary.append(f"{label}: {used}")
+        if limit is not None:
+            summary.append(f" (budget: {limit})")
+        summary.append("\n")
+    return summary
+
+
+# writes summary txt file after fitting, the summary is built in memory and written at once
+def summary_writer(
+    name, cv, userinput_dict, popt, baseline, peak_dict, x_reg, x_fit, r_squared, budget=None
+):
+    fitted_param_string = fitted_parameters(cv, userinput_dict, popt)
+    fitting_func_string = f"Fitting function: {diffusional_function(userinput_dict)} + {baseline.slope} + {baseline.intercept}*t\n"
+
+    summary = []
+    summary.append("DIFFUSIONAL FITTER SUMMARY\n")
+    summary.append(f"File: {userinput_dict['filename']}\n")
+    summary.append(
+        f"Delta Ep: {cv.delta_Ep} V, Ip1: {peak_dict['Ip1']} {cv.report_scale_prefix}A, Ip2: {peak_dict['Ip2']} {cv.report_scale_prefix}A, peak ratio: {peak_dict['peak_ratio']}\n\n"
+    )
+
+    summary.append("LINEAR FIT (Forward peak baseline)\n")
+    if userinput_dict["cap_check"]:
+        summary.append("Fitting range selection: automatic\n")
+    else:
+        summary.append("Fitting range selection: manual\n")
+    summary.append(f"Linear fit range: {x_reg[0]} - {x_reg[len(x_reg)-1]} s\n")
+    summary.append(f"Fitting function: slope*t + intercept\n")
+    summary.append(
+        f"slope: {str(baseline.slope)} {cv.report_scale_prefix}A / s\nintercept: {str(baseline.intercept)} {cv.report_scale_prefix}A\nR-squared: {str(baseline.rvalue**2)}\n\n"
+    )
+
+    summary.append(f"{userinput_dict['dif_func'].upper()} FIT (Backpeak baseline)\n")
+    if userinput_dict["fit_range_check"]:
+        summary.append("Fitting range selection: automatic\n")
+    else:
+        summary.append("Fitting range selection: manual\n")
+
+    summary.append(
+        f"{userinput_dict['dif_func']} fit range: {x_fit[0]} - {x_fit[len(x_fit)-1]} s\n"
+    )
+    summary.append(fitting_func_string)
+    summary.append(fitted_param_string)
+    summary.append(f"R-squared: {r_squared}\n")
+    summary += budget_summary(budget)
+    summary += memory_summary(userinput_dict)
+
+    with atomic_open(f"{userinput_dict['output_dir']}/{name}.txt") as file:
+        file.write("".join(summary))
+
+
+# writes summary txt file for a voltammogram with several couples, with a table of results for
+# all couples followed by the linear fit and the diffusional fit of each couple
+def multi_summary_writer(
+    name,
+    cv,
+    userinput_dict,
+    baseline,
+    x_reg,
+    couple_fits,
+    budget=None,
+    couples_found=None,
+    unpaired=(),
+):
+    unit = cv.report_scale_prefix
+    summary = []
+    summary.append("DIFFUSIONAL FITTER SUMMARY\n")
+    summary.append(f"File: {userinput_dict['filename']}\n")
+    summary.append(f"Couples: {len(couple_fits)}\n")
+    if couples_found is not None and couples_found > len(couple_fits):
+        summary.append(
+            f"Couples found: {couples_found}, later couples couldn't be fitted within the budget\n"
+        )
+    for sweep, E in unpaired:
+        summary.append(f"Unpaired {sweep} peak at {E} V, not fitted\n")
+    if any(sweep == "forward" for sweep, E in unpaired):
+        summary.append(
+            "Forward peaks after an unpaired forward peak include its diffusional current\n"
         )
+    summary.append("\n")
+
+    summary.append("RESULTS\n")
+    summary.append(
+        f"Couple\tE1/2 (V)\tDelta Ep (V)\tIp1 ({unit}A)\tIp2 ({unit}A)\tPeak ratio\tR-squared\n"
+    )
+    for fit in couple_fits:
+        couple, peak_dict = fit["couple"], fit["peak_dict"]
+        summary.append(
+            f"{couple.number}\t{couple.E_half}\t{couple.delta_Ep}\t{peak_dict['Ip1']}\t"
+            f"{peak_dict['Ip2']}\t{peak_dict['peak_ratio']}\t{fit['r_squared']}\n"
+        )
+    summary.append("\n")
 
-        summary.write(f"{userinput_dict['dif_func'].upper()} FIT (Backpeak baseline)\n")
-        if userinput_dict["fit_range_check"]:
-            summary.write("Fitting range selection: automatic\n")
+    summary.append("LINEAR FIT (Couple 1 forward peak baseline)\n")
+    if userinput_dict["cap_check"]:
+        summary.append("Fitting range selection: automatic\n")
+    else:
+        summary.append("Fitting range selection: manual\n")
+    summary.append(f"Linear fit range: {x_reg[0]} - {x_reg[len(x_reg)-1]} s\n")
+    summary.append(f"Fitting function: slope*t + intercept\n")
+    summary.append(
+        f"slope: {str(baseline.slope)} {unit}A / s\nintercept: {str(baseline.intercept)} {unit}A\nR-squared: {str(baseline.rvalue**2)}\n\n"
+    )
+
+    for fit in couple_fits:
+        couple, x_fit = fit["couple"], fit["x_fit"]
+        summary.append(f"COUPLE {couple.number} {userinput_dict['dif_func'].upper()} FIT\n")
+        if couple.number == 1:
+            summary.append("Forward peak baseline: linear fit\n")
         else:
-            summary.write("Fitting range selection: manual\n")
-
-        summary.write(
+            summary.append(f"Forward peak baseline: couple {couple.number - 1} fit\n")
+        if fit["tail"] is None:
+            summary.append("Backpeak baseline: this fit\n")
+        else:
+            summary.append("Backpeak baseline: return tail fit\n")
+        summary.append("Fitting range selection: automatic\n")
+        summary.append(
             f"{userinput_dict['dif_func']} fit range: {x_fit[0]} - {x_fit[len(x_fit)-1]} s\n"
         )
-        summary.write(fitting_func_string)
-        summary.write(fitted_param_string)
-        summary.write(f"R-squared: {r_squared}\n")
+        if couple.number > 1 and userinput_dict.get("chain_couples", True):
+            summary.append(
+                f"Fitting function: couple {couple.number - 1} fit + {diffusional_function(userinput_dict)}\n"
+            )
+        else:
+            summary.append(
+                f"Fitting function: {diffusional_function(userinput_dict)} + {baseline.slope} + {baseline.intercept}*t\n"
+            )
+        summary.append(fitted_parameters(cv, userinput_dict, fit["popt"]))
+        summary.append(f"R-squared: {fit['r_squared']}\n\n")
+
+        # return peak baseline including the tail of the return peaks of later couples
+        if fit["tail"] is not None:
+            tail, x_tail = fit["tail"], fit["tail"]["x_fit"]
+            summary.append(f"COUPLE {couple.number} RETURN TAIL FIT\n")
+            summary.append(
+                f"Return tail fit range: {x_tail[0]} - {x_tail[len(x_tail)-1]} s\n"
+            )
+            tail_dict = dict(userinput_dict, dif_func="Cottrellian")
+            summary.append(
+                f"Fitting function: couple {couple.number} fit + {diffusional_function(tail_dict)}\n"
+            )
+            summary.append(fitted_parameters(cv, tail_dict, tail["popt"]))
+            summary.append(f"R-squared: {tail['r_squared']}\n\n")
+    summary += budget_summary(budget)
+    summary += memory_summary(userinput_dict)
+
+    with atomic_open(f"{userinput_dict['output_dir']}/{name}.txt") as file:
+        file.write("".join(summary))
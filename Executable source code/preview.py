@@ -0,0 +1,254 @@
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel
+from PyQt5.QtCore import QTimer
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
+from matplotlib.widgets import SpanSelector
+import numpy as np
+import time
+from library import CV, diffusional_fit
+import fitter
+
+# time after the last drag event before refitting, so dragging a range doesn't queue up fits
+REFIT_DELAY_MS = 30
+
+
+# window showing the CV with draggable linear and diffusional fit ranges, the data file is
+# parsed once and only the stages affected by a range change are refitted
+class FitPreview(QWidget):
+    def __init__(self, userinput_dict, on_save=None):
+        super().__init__()
+        self.userinput_dict = dict(userinput_dict)
+        self.on_save = on_save
+        self.background = None
+        self.pending_stages = set()
+        self.baseline = self.x_reg = self.fitting_func = None
+
+        # parse data and perform initial fit using the options selected in the main window
+        self.cv = CV(self.userinput_dict)
+        self.time = np.array(self.cv.dataframe["Time"])
+        self.current = np.array(self.cv.dataframe["I"])
+        self.fit()
+
+        # ranges are switched to manual so refits are single fits, flags are restored on save
+        # for any stage that wasn't refitted so the summary reports how the range was chosen
+        self.range_checks = {
+            "cap_check": self.userinput_dict["cap_check"],
+            "fit_range_check": self.userinput_dict["fit_range_check"],
+        }
+        self.userinput_dict.update(
+            {
+                "cap_check": False,
+                "lin_fit_start": self.x_reg[0],
+                "lin_fit_end": self.range_end(self.x_reg),
+                "fit_range_check": False,
+                "dif_fit_start": self.x_fit[0],
+                "dif_fit_end": self.range_end(self.x_fit),
+            }
+        )
+
+        self.setWindowTitle(f"Fit preview - {self.cv.filename}")
+        self.resize(800, 600)
+        layout = QVBoxLayout()
+        layout.addWidget(
+            QLabel(
+                "Drag with the left mouse button to set the linear fit range, "
+                "and the right mouse button to set the diffusional fit range"
+            )
+        )
+
+        # plot with the fit lines animated so they can be redrawn by blitting
+        self.figure = Figure(tight_layout=True)
+        self.canvas = FigureCanvasQTAgg(self.figure)
+        ax = self.ax = self.figure.add_subplot()
+        ax.set_ylabel(f"I ({self.cv.scale_prefix}A)")
+        ax.set_xlabel("Time (s)")
+        ax.plot(self.time, self.current)
+        line_props = {"linewidth": 2, "color": "black", "animated": True}
+        (self.base_extrap_line,) = ax.plot([], [], ls="dotted", **line_props)
+        (self.base_line,) = ax.plot([], [], **line_props)
+        (self.peak_line,) = ax.plot([], [], ls="dotted", **line_props)
+        (self.dif_extrap_line,) = ax.plot([], [], ls="dotted", **line_props)
+        (self.dif_line,) = ax.plot([], [], **line_props)
+        (self.peak2_line,) = ax.plot([], [], ls="dotted", **line_props)
+        layout.addWidget(self.canvas)
+
+        # span selectors, left button for the linear fit and right button for the diffusional fit
+        self.base_selector = SpanSelector(
+            ax,
+            self.base_range_selected,
+            "horizontal",
+            useblit=True,
+            button=1,
+            interactive=True,
+            props={"facecolor": "tab:green", "alpha": 0.2},
+            onmove_callback=self.base_range_selected,
+        )
+        self.dif_selector = SpanSelector(
+            ax,
+            self.dif_range_selected,
+            "horizontal",
+            useblit=True,
+            button=3,
+            interactive=True,
+            props={"facecolor": "tab:orange", "alpha": 0.2},
+            onmove_callback=self.dif_range_selected,
+        )
+
+        # refits wait until dragging pauses
+        self.refit_timer = QTimer()
+        self.refit_timer.setSingleShot(True)
+        self.refit_timer.setInterval(REFIT_DELAY_MS)
+        self.refit_timer.timeout.connect(self.refit)
+
+        self.status = QLabel()
+        layout.addWidget(self.status)
+        hbox_buttons = QHBoxLayout()
+        save_button = QPushButton("Save plot and summary")
+        close_button = QPushButton("Close")
+        hbox_buttons.addWidget(save_button)
+        hbox_buttons.addWidget(close_button)
+        layout.addLayout(hbox_buttons)
+        save_button.clicked.connect(self.save)
+        close_button.clicked.connect(self.close)
+        self.setLayout(layout)
+
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.base_selector.extents = (self.x_reg[0], self.x_reg[-1])
+        self.dif_selector.extents = (self.x_fit[0], self.x_fit[-1])
+        self.update_artists()
+        self.update_status()
+
+    # time one index past the end of a fitted range, manual ranges exclude their end index
+    def range_end(self, x):
+        i_end = min(np.searchsorted(self.time, x[-1]) + 1, len(self.time) - 1)
+        return self.time[i_end]
+
+    # refits the baseline when needed and the diffusional fit, which depends on the baseline,
+    # results are only kept if both stages succeed
+    def fit(self, refit_baseline=True):
+        baseline, x_reg = self.baseline, self.x_reg
+        fitting_func = self.fitting_func
+        if refit_baseline:
+            baseline, x_reg, y_reg = fitter.baseline_fit(self.cv, self.userinput_dict)
+            fitting_func = fitter.fitting_function(self.userinput_dict, self.cv, baseline)
+        popt, x_fit, r_squared = diffusional_fit(
+            self.cv,
+            self.userinput_dict,
+            fitter.fitting_bounds(self.userinput_dict, self.cv),
+            fitting_func,
+        )
+        self.baseline, self.x_reg, self.fitting_func = baseline, x_reg, fitting_func
+        self.popt, self.x_fit, self.r_squared = popt, x_fit, r_squared
+
+    # empty spans come from single clicks and are ignored
+    def base_range_selected(self, vmin, vmax):
+        if vmax <= vmin:
+            return
+        self.userinput_dict.update({"lin_fit_start": vmin, "lin_fit_end": vmax})
+        self.range_checks["cap_check"] = False
+        self.queue_refit("baseline")
+
+    def dif_range_selected(self, vmin, vmax):
+        if vmax <= vmin:
+            return
+        self.userinput_dict.update({"dif_fit_start": vmin, "dif_fit_end": vmax})
+        self.range_checks["fit_range_check"] = False
+        self.queue_refit("diffusional")
+
+    def queue_refit(self, stage):
+        self.pending_stages.add(stage)
+        self.refit_timer.start()
+        self.blit()
+
+    def refit(self):
+        start = time.perf_counter()
+        try:
+            self.fit("baseline" in self.pending_stages)
+        except Exception:
+            self.status.setText("Fit failed, try a wider range")
+            return
+        finally:
+            self.pending_stages.clear()
+        # the diffusional fit is always redone over the fixed range, so it is no longer the
+        # range an automatic search would choose once the baseline changes
+        self.range_checks["fit_range_check"] = False
+        self.update_artists()
+        self.blit()
+        self.update_status(time.perf_counter() - start)
+
+    def update_artists(self):
+        cv, baseline, popt = self.cv, self.baseline, self.popt
+        x_base = self.time[0 : cv.i_1st_peak]
+        self.base_extrap_line.set_data(x_base, x_base * baseline.slope + baseline.intercept)
+        self.base_line.set_data(self.x_reg, self.x_reg * baseline.slope + baseline.intercept)
+        self.peak_line.set_data(
+            [cv.t_1st_peak, cv.t_1st_peak],
+            [cv.t_1st_peak * baseline.slope + baseline.intercept, cv.forwardpeak_current],
+        )
+        extrap_x = np.linspace(self.x_fit[0], cv.t_2nd_peak, 100)
+        self.dif_extrap_line.set_data(extrap_x, self.fitting_func(extrap_x, *popt))
+        self.dif_line.set_data(self.x_fit, self.fitting_func(self.x_fit, *popt))
+        self.peak2_line.set_data(
+            [cv.t_2nd_peak, cv.t_2nd_peak],
+            [self.fitting_func(cv.t_2nd_peak, *popt), cv.backpeak_current],
+        )
+
+    def update_status(self, refit_time=None):
+        peak_dict = fitter.peak_currents(self.cv, self.baseline, self.fitting_func, self.popt)
+        text = (
+            f"Ip1: {round(peak_dict['Ip1'], 1)} {self.cv.scale_prefix}A, "
+            f"Ip2: {round(peak_dict['Ip2'], 1)} {self.cv.scale_prefix}A, "
+            f"peak ratio: {peak_dict['peak_ratio']}, "
+            f"linear fit R\u00b2: {round(self.baseline.rvalue**2, 6)}, "
+            f"{self.userinput_dict['dif_func']} fit R\u00b2: {round(self.r_squared, 6)}"
+        )
+        if refit_time is not None:
+            text += f" ({round(refit_time * 1000)} ms)"
+        self.status.setText(text)
+
+    # caches the plot without animated artists after every full redraw
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        artists = [artist for artist in self.ax.get_children() if artist.get_animated()]
+        for artist in sorted(artists, key=lambda artist: artist.get_zorder()):
+            self.ax.draw_artist(artist)
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.figure.bbox)
+
+    # writes the plot and summary from the current fit without reparsing or refitting
+    def save(self):
+        # ranges are taken from the current fit in case the last refit failed
+        userinput_dict = dict(
+            self.userinput_dict,
+            lin_fit_start=self.x_reg[0],
+            lin_fit_end=self.range_end(self.x_reg),
+            dif_fit_start=self.x_fit[0],
+            dif_fit_end=self.range_end(self.x_fit),
+            **self.range_checks,
+        )
+        try:
+            fitter.save_fit(
+                self.cv,
+                userinput_dict,
+                self.baseline,
+                self.x_reg,
+                self.popt,
+                self.x_fit,
+                self.r_squared,
+                self.fitting_func,
+            )
+        except Exception:
+            self.status.setText("Could not save plot and summary, check output folder")
+            return
+        if self.on_save is not None:
+            self.on_save(userinput_dict)
+        self.close()
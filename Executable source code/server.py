@@ -0,0 +1,199 @@
+"""
+long running local fitting server. Fit jobs are received as JSON lines on a unix socket (or a
+localhost port where unix sockets aren't available) and run on a pool of worker processes which
+keep the fitting modules loaded between jobs, results are streamed back as each job completes.
+Use client.py, or the client.fit function, to send jobs.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from client import DEFAULT_ADDRESS, parse_address
+from library import data_format
+
+# options used for any not given in a job, the same as the GUI defaults
+DEFAULT_OPTIONS = {
+    "data_format": "Detect automatically",
+    "name": "",
+    "cap_check": True,
+    "lin_fit_start": "",
+    "lin_fit_end": "",
+    "fit_range_check": True,
+    "dif_fit_start": "",
+    "dif_fit_end": "",
+    "dif_func": "Cottrellian",
+}
+
+ARRAY_FORMAT = "In-memory arrays"
+
+
+# jobs with a "data" dict of E (V) and I (A) lists, and either a Time (s) list or the scan rate,
+# are read through the data format registry like any other data. Files never match the format,
+# so it is only used when selected by the server
+@data_format(ARRAY_FORMAT, sniff=lambda head: False)
+def array_reader(userinput_dict):
+    data = userinput_dict["data"]
+    buffer = np.empty((len(data["E"]), 3), order="F")
+    buffer[:, 0] = data["E"]
+    buffer[:, 1] = data["I"]
+    buffer[:, 2] = data["Time"] if "Time" in data else np.arange(len(buffer))
+    metadata = {
+        "scan_rate": data.get("scan_rate"),
+        "V_per_index": None,
+        "current_unit": "",
+        "time": "Time" in data,
+    }
+    return buffer, metadata
+
+
+# imports the fitting modules when a worker process starts rather than in its first job
+def warm_up():
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import fitter
+
+    # loads the font cache used for plots
+    plt.figure()
+    plt.close()
+
+
+# fitter options for a job, checked before the job is submitted so invalid jobs fail without
+# being fitted. Jobs with in-memory data aren't saved unless they ask to be
+def job_options(job):
+    userinput_dict = dict(DEFAULT_OPTIONS, **job)
+    if "data" not in userinput_dict and "filename" not in userinput_dict:
+        raise ValueError("jobs need a filename or data")
+    if "data" in userinput_dict:
+        data = userinput_dict["data"]
+        if not isinstance(data, dict) or "E" not in data or "I" not in data:
+            raise ValueError("data needs E (V) and I (A) lists")
+        if "Time" not in data and "scan_rate" not in data:
+            raise ValueError("data needs a Time (s) list or the scan_rate")
+        columns = [data[key] for key in ["E", "I", "Time"] if key in data]
+        if not all(isinstance(column, list) for column in columns):
+            raise ValueError("data E, I and Time must be lists")
+        if len({len(column) for column in columns}) != 1:
+            raise ValueError("data E, I and Time lists must be the same length")
+        userinput_dict["data_format"] = ARRAY_FORMAT
+        userinput_dict.setdefault("filename", "In-memory arrays")
+        userinput_dict.setdefault("save", False)
+    if userinput_dict.get("save", True) and "output_dir" not in userinput_dict:
+        raise ValueError("jobs which save a plot and summary need an output_dir")
+    return userinput_dict
+
+
+def run_job(userinput_dict):
+    import fitter
+
+    return fitter.fitter(userinput_dict)
+
+
+# reads jobs from a connection and submits each to the worker pool as it arrives, results are
+# written back by the pool's callbacks in the order jobs complete
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        write_lock = threading.Lock()
+        answered = []
+
+        def send(response):
+            with write_lock:
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+        def on_done(job_id, future, event):
+            try:
+                response = {"id": job_id, "results": future.result()}
+            except Exception as error:
+                response = {"id": job_id, "error": f"{type(error).__name__}: {error}"}
+            try:
+                send(response)
+            except OSError:
+                pass  # client disconnected
+            finally:
+                event.set()
+
+        for counter, line in enumerate(self.rfile):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as error:
+                send({"id": None, "error": f"Invalid job: {error}"})
+                continue
+            if not isinstance(job, dict):
+                send({"id": None, "error": "Invalid job: expected a JSON object"})
+                continue
+            job_id = job.pop("id", counter)
+            try:
+                userinput_dict = job_options(job)
+            except ValueError as error:
+                send({"id": job_id, "error": f"Invalid job: {error}"})
+                continue
+            event = threading.Event()
+            future = self.server.pool.submit(run_job, userinput_dict)
+            future.add_done_callback(
+                lambda future, job_id=job_id, event=event: on_done(job_id, future, event)
+            )
+            answered.append(event)
+
+        # the client has sent all its jobs, keep the connection open until all are answered
+        for event in answered:
+            event.wait()
+
+
+class FitServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=None):
+        self.address_family, address = parse_address(address)
+        if self.address_family != socket.AF_INET and os.path.exists(address):
+            with socket.socket(self.address_family) as probe:
+                if probe.connect_ex(address) == 0:
+                    raise OSError(f"A server is already listening on {address}")
+            os.remove(address)  # left behind by a server which didn't shut down cleanly
+        # workers are started now rather than by the first job, and are spawned rather than
+        # forked as jobs are submitted from the connection threads
+        self.pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"), initializer=warm_up
+        )
+        self.pool.submit(int).result()
+        super().__init__(address, JobHandler)
+        if self.address_family != socket.AF_INET:
+            os.chmod(address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+        if self.address_family != socket.AF_INET and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="socket path or host:port")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per CPU by default")
+    args = parser.parse_args()
+
+    # stop cleanly when terminated so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with FitServer(args.address, args.workers) as server:
+        print(f"Fitting server listening on {args.address}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()